@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import monero_data_ff
+
+
+# Compares today's 'etf_daily_return.csv' loading path with
+# monero_data_ff.read_etf_daily_return, on the shipped file and on a synthetic
+# 50 years x 500 etfs file.
+#   python bench_etf_loader_ff.py [n_repeat]
+
+def load_current(file_name_etf):
+    df_tr = pd.read_csv(file_name_etf, index_col='Dates')
+    df_tr.index = pd.to_datetime(df_tr.index)
+    return df_tr
+
+
+def make_synthetic_csv(file_name_etf, n_year = 50, n_etf = 500, seed = 0):
+    dates = pd.bdate_range('1970-01-01', periods = n_year * 252)
+    rng = np.random.RandomState(seed)
+    df_tr = pd.DataFrame(
+        rng.normal(0.0003, 0.01, size = (len(dates), n_etf)),
+        index = dates.strftime(monero_data_ff.ETF_DATE_FORMAT),
+        columns = ['ETF {}'.format(i) for i in range(n_etf)]
+        )
+    df_tr.index.name = 'Dates'
+    df_tr.to_csv(file_name_etf)
+
+
+def clear_sidecar(file_name_etf):
+    for dtype in [np.float32, np.float64]:
+        for path in monero_data_ff._sidecar_paths(file_name_etf, dtype).values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def best_time(func, n_repeat, setup = None):
+    times = []
+    for _ in range(n_repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run_bench(file_name_etf, n_repeat):
+    result = {}
+    result['current'] = best_time(lambda: load_current(file_name_etf), n_repeat)
+    result['typed'] = best_time(
+        lambda: monero_data_ff.read_etf_daily_return(file_name_etf, sidecar = False), n_repeat)
+    result['typed float32'] = best_time(
+        lambda: monero_data_ff.read_etf_daily_return(file_name_etf, float32 = True, sidecar = False), n_repeat)
+    result['typed + write sidecar'] = best_time(
+        lambda: monero_data_ff.read_etf_daily_return(file_name_etf), n_repeat,
+        setup = lambda: clear_sidecar(file_name_etf))
+    result['sidecar mmap'] = best_time(
+        lambda: monero_data_ff.read_etf_daily_return(file_name_etf), n_repeat)
+    monero_data_ff.read_etf_daily_return(file_name_etf, float32 = True)
+    result['sidecar mmap float32'] = best_time(
+        lambda: monero_data_ff.read_etf_daily_return(file_name_etf, float32 = True), n_repeat)
+    return result
+
+
+def print_result(title, result):
+    print(title)
+    base = result['current']
+    for k, v in result.items():
+        print('  {:<24s}{:>10.4f}s{:>9.1f}x'.format(k, v, base / v))
+
+
+if __name__ == '__main__':
+    n_repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        shipped = os.path.join(tmp_dir, 'etf_daily_return.csv')
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'etf_daily_return.csv'), shipped)
+        print_result('etf_daily_return.csv', run_bench(shipped, n_repeat))
+
+        synthetic = os.path.join(tmp_dir, 'synthetic_50y_500etf.csv')
+        make_synthetic_csv(synthetic)
+        print_result('synthetic 50y x 500 etfs', run_bench(synthetic, n_repeat))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,164 @@
+import os
+import sys
+import shutil
+import tempfile
+
+import numpy as np
+from pypfopt import risk_models
+
+import monero_data_ff
+import monero_engine_ff
+import monero_utils_ff
+
+
+# Checks the engines against each other and against pypfopt and statsmodels
+# on a SyntheticProvider market, exits with status 1 when one of them fails.
+#   python check_engines_ff.py [n_months] [seed]
+
+ACCOUNT = 'retirement'
+WINDOW = 60
+
+
+def make_context(n_months, seed = 1):
+    return monero_utils_ff.DataContext(provider = monero_data_ff.SyntheticProvider(n_assets = 17, n_months = n_months, seed = seed))
+
+
+# the market of a SyntheticProvider up to the end of one of its months, the
+# data an earlier run had
+class TruncatedProvider(monero_data_ff.MarketDataProvider):
+
+    def __init__(self, provider, end):
+        self.provider = provider
+        self.end = end
+
+    def daily_returns(self):
+        return self.provider.daily_returns().loc[:self.end]
+
+    def factor_returns(self):
+        return {region: factors.loc[:self.end] for region, factors in self.provider.factor_returns().items()}
+
+    def region_assets(self):
+        return self.provider.region_assets()
+
+
+def make_context_until(n_months, seed, until):
+    provider = monero_data_ff.SyntheticProvider(n_assets = 17, n_months = n_months, seed = seed)
+    end = provider.factor_returns()[list(provider.region_assets())[0]].index[until - 1]
+    return monero_utils_ff.DataContext(provider = TruncatedProvider(provider, end))
+
+
+def max_wgt_diff(wgt_dict, other_dict):
+    return max(np.abs(wgt_dict[a].values - other_dict[a].values).max() for a in wgt_dict)
+
+
+# the process pool solves every window like the serial solver, also from the
+# memory-mapped inputs the workers read
+def check_parallel(ctx, workers = 2):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cov = np.memmap(os.path.join(tmp_dir, 'cov.dat'), dtype = np.float64, mode = 'w+', shape = (1, 3, 3))
+        cov[0] = np.diag([0.04, 0.09, 0.16])
+        plain = type(monero_engine_ff.scaled_cov_factor(cov[0])[0]) is np.ndarray
+        del cov
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    serial = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, ctx, workers = 1)
+    parallel = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, ctx, workers = workers, chunk_size = 3)
+    diff = max_wgt_diff(serial, parallel)
+    return plain and diff == 0, 'plain arrays from memmaps: {}, max weight diff: {:.2e}'.format(plain, diff)
+
+
+# (windows x 10) volatility of every portfolio of the weights
+def portfolio_volatility(ctx, wgt_dict):
+    asset_rf = monero_utils_ff.make_excess_return_df(ACCOUNT, ctx)
+    cov, _ = monero_engine_ff.ledoit_wolf_single_factor(asset_rf.values, WINDOW, len(wgt_dict), ctx.periods_per_year())
+    wgt = np.array([wgt_dict[a].values for a in range(len(wgt_dict))])
+    return np.sqrt(np.einsum('wkn,wnm,wkm->wk', wgt, cov, wgt))
+
+
+# the parametric engine re-solves one cvxpy problem into the very weights of
+# a new EfficientFrontier.efficient_risk per target (reference: the weights
+# of engine = 'efficient_frontier')
+def check_parametric(ctx, reference):
+    parametric = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, ctx, engine = 'parametric')
+    diff = max_wgt_diff(reference, parametric)
+    return diff == 0, 'max weight diff: {:.2e}'.format(diff)
+
+
+# the ADMM engine (with its active-set polish and cvxpy fallback) finds the
+# portfolios of EfficientFrontier.efficient_risk: the same weights, up to
+# the solvers' tolerance, at the same volatility
+def check_admm(ctx, reference, wgt_tol = 5e-4, vol_tol = 1e-4):
+    admm = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, ctx, engine = 'admm')
+    wgt_diff = max_wgt_diff(reference, admm)
+    vol_diff = np.abs(portfolio_volatility(ctx, reference) - portfolio_volatility(ctx, admm)).max()
+    return wgt_diff <= wgt_tol and vol_diff <= vol_tol, 'max weight diff: {:.2e} (tol {:.0e}), max volatility diff: {:.2e} (tol {:.0e})'.format(
+        wgt_diff, wgt_tol, vol_diff, vol_tol)
+
+
+# the batched and the incremental regression engines fit the same values
+# as one statsmodels OLS per asset and window
+def check_regression(ctx, tol = 1e-10):
+    reference = monero_utils_ff.make_expected_return_dict(ACCOUNT, WINDOW, ctx, engine = 'statsmodels')
+    diff_list = []
+    for engine in ['batched', 'incremental']:
+        fitted = monero_utils_ff.make_expected_return_dict(ACCOUNT, WINDOW, ctx, engine = engine)
+        diff_list.append(max(np.abs(fitted[a][reference[a].columns].values - reference[a].values).max() for a in reference))
+    return max(diff_list) <= tol, 'max fitted diff batched: {:.2e}, incremental: {:.2e} (tol {:.0e})'.format(
+        diff_list[0], diff_list[1], tol)
+
+
+# the covariance of every window in one batch is pypfopt's single-factor
+# Ledoit-Wolf estimate of that window
+def check_covariance(ctx, tol = 1e-12):
+    asset_rf_dict = monero_utils_ff.make_asset_rf_dict(ACCOUNT, WINDOW, ctx)
+    asset_rf = monero_utils_ff.make_excess_return_df(ACCOUNT, ctx)
+    freq = ctx.periods_per_year()
+    cov, _ = monero_engine_ff.ledoit_wolf_single_factor(asset_rf.values, WINDOW, len(asset_rf_dict), freq)
+    diff = max(np.abs(cov[a] - risk_models.risk_matrix(
+        asset_rf_dict[a], method = 'ledoit_wolf_single_factor', returns_data = True, frequency = freq).values).max()
+        for a in asset_rf_dict)
+    return diff <= tol, 'max covariance diff: {:.2e} (tol {:.0e})'.format(diff, tol)
+
+
+# a run on the first n_months - k months saved to a WindowStore, then one on
+# all the months that only solves the k new windows, gives the weights of a
+# run with no store
+def check_window_store(n_months, seed = 1, k = 3):
+    reference = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, make_context(n_months, seed))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        window_store = monero_data_ff.WindowStore(store_dir = tmp_dir)
+        monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, make_context_until(n_months, seed, n_months - k),
+                                                 window_store = window_store)
+        solve_log = monero_engine_ff.SolveLog()
+        stored = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, make_context(n_months, seed), solve_log = solve_log,
+                                                          window_store = window_store)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+    solved = sorted(set(record['window'] for record in solve_log.records))
+    diff = max_wgt_diff(reference, stored)
+    return solved == list(range(len(reference) - k, len(reference))) and diff == 0, 'windows solved: {}, max weight diff: {:.2e}'.format(
+        solved, diff)
+
+
+def print_result(title, result):
+    ok, detail = result
+    print('  {:<14s}{:<6s}{}'.format(title, 'ok' if ok else 'FAIL', detail))
+    return ok
+
+
+if __name__ == '__main__':
+    n_months = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    ctx = make_context(n_months, seed)
+    print('synthetic {} months x 17 assets, seed {}'.format(n_months, seed))
+    ok = print_result('parallel', check_parallel(ctx))
+    reference = monero_utils_ff.make_port_asset_wgt_dict(ACCOUNT, WINDOW, ctx, engine = 'efficient_frontier')
+    ok = print_result('parametric', check_parametric(ctx, reference)) and ok
+    ok = print_result('admm', check_admm(ctx, reference)) and ok
+    ok = print_result('regression', check_regression(ctx)) and ok
+    ok = print_result('covariance', check_covariance(ctx)) and ok
+    ok = print_result('window store', check_window_store(n_months, seed)) and ok
+    sys.exit(0 if ok else 1)
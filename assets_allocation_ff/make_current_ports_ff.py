@@ -0,0 +1,57 @@
+import monero_utils_ff
+import monero_data_ff
+import monero_engine_ff
+from datetime import date
+import os
+
+
+# Refreshes only the recommended allocations ('asset_weights_*.csv') from the
+# latest window, independent of the backtest in make_monero_ports_ff.py.
+
+### 0. Pre-settings
+
+# where to put the results
+result_path = '/home/shafqat/Downloads/Roboadvisor_Project_Documentation/'
+
+# where the 'etf_daily_return.csv' saved
+os.chdir(r'/home/shafqat/Downloads/Roboadvisor_Project_Documentation')
+
+# freq & window settings, the same as the backtest's
+rebalance_freq = 'M' # 'M' or 'Q' ('W' needs daily factor sets)
+freq = monero_engine_ff.periods_per_year(rebalance_freq)
+window_yr = 5 # 5yrs
+window = freq * window_yr
+
+# Fama-French factor cache, re-downloaded when older than a week
+factor_cache = monero_data_ff.FactorCache(cache_dir = 'factor_cache', ttl_days = 7, refresh = False, offline = False)
+
+# daily etf returns, seeded from 'etf_daily_return.csv' and refreshed with new days only
+price_store = monero_data_ff.PriceStore(store_dir = 'price_store')
+
+# weights of the backtest's walk-forward runs, reused when the latest window
+# is stored already
+window_store = monero_data_ff.WindowStore(store_dir = 'window_store')
+
+
+### 1. make current monero ports
+
+fetcher = monero_data_ff.RemoteFetcher(max_workers = 8, max_per_second = 5)
+
+ctx = monero_utils_ff.DataContext(factor_cache = factor_cache, price_store = price_store, fetcher = fetcher, freq = rebalance_freq)
+ctx.prefetch()
+
+retirement_current_port = monero_utils_ff.make_current_port_asset_wgt_df(account = 'retirement', window = window, ctx = ctx, window_store = window_store)
+taxable_current_port = monero_utils_ff.make_current_port_asset_wgt_df(account = 'taxable', window = window, ctx = ctx, window_store = window_store)
+
+
+### 2. export to csv files
+
+today = date.today().strftime('%Y-%m-%d')
+result_folder = result_path + today +"_ff"
+os.makedirs(result_folder, exist_ok = True)
+
+file_name = result_folder + '/asset_weights_retirement.csv'
+retirement_current_port.to_csv(file_name)
+
+file_name = result_folder + '/asset_weights_taxable.csv'
+taxable_current_port.to_csv(file_name)
@@ -1,4 +1,6 @@
 import monero_utils_ff
+import monero_data_ff
+import monero_engine_ff
 from datetime import date
 import os
 
@@ -12,22 +14,63 @@ result_path = '/home/shafqat/Downloads/Roboadvisor_Project_Documentation/'
 os.chdir(r'/home/shafqat/Downloads/Roboadvisor_Project_Documentation')
 
 # freq & window settings
-freq = 12 #monthly data
+rebalance_freq = 'M' # 'M' or 'Q' ('W' needs daily factor sets)
+freq = monero_engine_ff.periods_per_year(rebalance_freq)
 window_yr = 5 # 5yrs
 window = freq * window_yr
 
+# Fama-French factor cache, re-downloaded when older than a week
+factor_cache = monero_data_ff.FactorCache(cache_dir = 'factor_cache', ttl_days = 7, refresh = False, offline = False)
+
+# daily etf returns, seeded from 'etf_daily_return.csv' and refreshed with new days only
+price_store = monero_data_ff.PriceStore(store_dir = 'price_store')
+
+# processes solving the portfolios, 1 = no process pool, None = one per core
+# (the pool forks this script, keep 1 where processes are spawned instead)
+workers = 1
+
+# cvxpy solvers tried in turn, None = monero_engine_ff.DEFAULT_SOLVERS
+solver = None
+
+# one line per solve in 'solve_log.jsonl', summarised in the results folder
+solve_log = monero_engine_ff.SolveLog(path = 'solve_log.jsonl')
+
+# backtest rebalancing: 'M' or 'Q' trades back to target at the start of each
+# period and lets the weights drift in between, None every period; threshold
+# also trades once a weight drifted that far from target (e.g. 0.05)
+rebalance = None
+threshold = None
+
+# daily backtest (each period's weights drifting day by day) for the daily
+# volatility and MDD columns of the statistics
+daily_backtest = True
+
+# walk-forward run: the weights of earlier runs are kept in 'window_store' and
+# only the windows since are computed (everything again after a change of
+# settings or of past data), None recomputes every window
+window_store = monero_data_ff.WindowStore(store_dir = 'window_store')
+
 
 ### 1. make monero ports
 
-retirement_port_asset_wgt_dict = monero_utils_ff.make_port_asset_wgt_dict(account='retirement', window = window)
-retirement_backtest_wgt = monero_utils_ff.make_backtest_wgt_dict(account = 'retirement', window = window, data_dict = retirement_port_asset_wgt_dict)
-retirememt_port_rt = monero_utils_ff.make_portfolio_rt_df(account = 'retirement', data_dict = retirement_backtest_wgt)
-retirememt_port_analysis = monero_utils_ff.make_port_analysis_df(retirememt_port_rt)
+# concurrent downloads, retried with backoff, at most 5 requests a second
+fetcher = monero_data_ff.RemoteFetcher(max_workers = 8, max_per_second = 5)
+
+# prices and factors are loaded once and shared by both accounts
+ctx = monero_utils_ff.DataContext(factor_cache = factor_cache, price_store = price_store, fetcher = fetcher, freq = rebalance_freq)
+ctx.prefetch()
+
+retirement_port_asset_wgt_dict = monero_utils_ff.make_port_asset_wgt_dict(account='retirement', window = window, ctx = ctx, workers = workers, solver = solver, solve_log = solve_log, window_store = window_store)
+retirement_backtest_wgt = monero_utils_ff.make_backtest_wgt_dict(account = 'retirement', window = window, data_dict = retirement_port_asset_wgt_dict, ctx = ctx)
+retirememt_port_rt = monero_utils_ff.make_portfolio_rt_df(account = 'retirement', data_dict = retirement_backtest_wgt, ctx = ctx, rebalance = rebalance, threshold = threshold)
+retirememt_port_daily_rt = monero_utils_ff.make_daily_portfolio_rt_df(account = 'retirement', data_dict = retirement_backtest_wgt, ctx = ctx) if daily_backtest else None
+retirememt_port_analysis = monero_utils_ff.make_port_analysis_df(retirememt_port_rt, ctx = ctx, daily_df = retirememt_port_daily_rt)
 
-taxable_port_asset_wgt_dict = monero_utils_ff.make_port_asset_wgt_dict(account='taxable', window = window)
-taxable_backtest_wgt = monero_utils_ff.make_backtest_wgt_dict(account = 'taxable', window = window, data_dict = taxable_port_asset_wgt_dict)
-taxable_port_rt = monero_utils_ff.make_portfolio_rt_df(account = 'taxable', data_dict = taxable_backtest_wgt)
-taxable_port_analysis = monero_utils_ff.make_port_analysis_df(taxable_port_rt)
+taxable_port_asset_wgt_dict = monero_utils_ff.make_port_asset_wgt_dict(account='taxable', window = window, ctx = ctx, workers = workers, solver = solver, solve_log = solve_log, window_store = window_store)
+taxable_backtest_wgt = monero_utils_ff.make_backtest_wgt_dict(account = 'taxable', window = window, data_dict = taxable_port_asset_wgt_dict, ctx = ctx)
+taxable_port_rt = monero_utils_ff.make_portfolio_rt_df(account = 'taxable', data_dict = taxable_backtest_wgt, ctx = ctx, rebalance = rebalance, threshold = threshold)
+taxable_port_daily_rt = monero_utils_ff.make_daily_portfolio_rt_df(account = 'taxable', data_dict = taxable_backtest_wgt, ctx = ctx) if daily_backtest else None
+taxable_port_analysis = monero_utils_ff.make_port_analysis_df(taxable_port_rt, ctx = ctx, daily_df = taxable_port_daily_rt)
 
 
 ### 2. export to csv files
@@ -44,6 +87,10 @@ retirement_current_port.to_csv(file_name)
 file_name = result_folder + '/portfolio_returns_retirement.csv'
 retirememt_port_rt.to_csv(file_name)
 
+if daily_backtest:
+    file_name = result_folder + '/portfolio_daily_returns_retirement.csv'
+    retirememt_port_daily_rt.to_csv(file_name)
+
 file_name = result_folder + '/portfolio_advanced_statistics_retirement.csv'
 retirememt_port_analysis.to_csv(file_name)
 
@@ -55,5 +102,12 @@ taxable_current_port.to_csv(file_name)
 file_name = result_folder + '/portfolio_returns_taxable.csv'
 taxable_port_rt.to_csv(file_name)
 
+if daily_backtest:
+    file_name = result_folder + '/portfolio_daily_returns_taxable.csv'
+    taxable_port_daily_rt.to_csv(file_name)
+
 file_name = result_folder + '/portfolio_advanced_statistics_taxable.csv'
-taxable_port_analysis.to_csv(file_name)
\ No newline at end of file
+taxable_port_analysis.to_csv(file_name)
+
+file_name = result_folder + '/solver_summary.csv'
+solve_log.summary().to_csv(file_name)
\ No newline at end of file
@@ -0,0 +1,540 @@
+import os
+import abc
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tenacity
+from pandas_datareader.famafrench import FamaFrenchReader
+
+
+###1
+# Local copy of the Fama-French factor sets.
+# Frames are stored already parsed and rescaled (/100) as parquet files, one per
+# dataset, and re-downloaded only once they are older than 'ttl_days'.
+#   refresh: always download and overwrite the cached copy
+#   offline: never touch the network, a missing dataset raises FileNotFoundError
+class FactorCache:
+
+    def __init__(self, cache_dir = 'factor_cache', ttl_days = 7, refresh = False, offline = False):
+        self.cache_dir = cache_dir
+        self.ttl_days = ttl_days
+        self.refresh = refresh
+        self.offline = offline
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name + '.parquet')
+
+    def age_days(self, name):
+        return (time.time() - os.path.getmtime(self.path(name))) / (24 * 60 * 60)
+
+    def is_fresh(self, name):
+        return os.path.exists(self.path(name)) and self.age_days(name) <= self.ttl_days
+
+    def read(self, name):
+        return pd.read_parquet(self.path(name))
+
+    def write(self, name, factors):
+        os.makedirs(self.cache_dir, exist_ok = True)
+        tmp_path = self.path(name) + '.tmp'
+        factors.to_parquet(tmp_path)
+        os.replace(tmp_path, self.path(name))
+
+    # fetch: function(name) -> factor frame, called when the cache can't answer
+    def get(self, name, fetch):
+        if self.offline:
+            if not os.path.exists(self.path(name)):
+                raise FileNotFoundError('{} is not cached in {} and offline mode is on'.format(name, self.cache_dir))
+            return self.read(name)
+
+        if not self.refresh and self.is_fresh(name):
+            return self.read(name)
+
+        factors = fetch(name)
+        self.write(name, factors)
+        return factors
+
+
+###2
+# Append-only store of daily etf returns.
+# Every append writes a new parquet part file under 'parts/', and 'meta.json'
+# keeps the date range of each part and the last ingested date of each column,
+# so a refresh only needs the returns after those dates and a read only opens
+# the parts overlapping the requested dates.
+class PriceStore:
+
+    def __init__(self, store_dir = 'price_store'):
+        self.store_dir = store_dir
+        self.part_dir = os.path.join(store_dir, 'parts')
+        self.meta_path = os.path.join(store_dir, 'meta.json')
+
+    def _read_meta(self):
+        if not os.path.exists(self.meta_path):
+            return {'last_dates': {}, 'parts': [], 'next_part': 0}
+        with open(self.meta_path) as f:
+            return json.load(f)
+
+    def _write_meta(self, meta):
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, indent = 1)
+        os.replace(tmp_path, self.meta_path)
+
+    def _write_part(self, meta, tr):
+        os.makedirs(self.part_dir, exist_ok = True)
+        file_name = 'part-{:05d}.parquet'.format(meta['next_part'])
+        table = pa.Table.from_pandas(tr.rename_axis('Dates').reset_index(), preserve_index = False)
+        pq.write_table(table, os.path.join(self.part_dir, file_name))
+        meta['next_part'] += 1
+
+        return {
+            'file': file_name,
+            'start': str(tr.index[0].date()),
+            'end': str(tr.index[-1].date())
+            }
+
+    def is_empty(self):
+        return len(self._read_meta()['parts']) == 0
+
+    def columns(self):
+        return list(self._read_meta()['last_dates'].keys())
+
+    # last ingested date per column
+    def last_dates(self):
+        last_dates = self._read_meta()['last_dates']
+        return {k: pd.Timestamp(v) for k, v in last_dates.items()}
+
+    # tr: daily returns with a DatetimeIndex, one column per etf
+    # only the values after each column's last ingested date are written,
+    # returns the number of new rows
+    def append(self, tr):
+        meta = self._read_meta()
+        last_dates = self.last_dates()
+
+        new_tr = tr.sort_index().astype('float64')
+        for col in new_tr.columns:
+            if col in last_dates:
+                new_tr.loc[new_tr.index <= last_dates[col], col] = np.nan
+        new_tr = new_tr.dropna(how = 'all')
+        if new_tr.empty:
+            return 0
+
+        meta['parts'].append(self._write_part(meta, new_tr))
+        for col in new_tr.columns:
+            valid = new_tr[col].dropna()
+            if len(valid) > 0:
+                meta['last_dates'][col] = str(valid.index[-1].date())
+        self._write_meta(meta)
+
+        return len(new_tr)
+
+    def read(self, start = None, end = None, columns = None):
+        meta = self._read_meta()
+        start = None if start is None else pd.Timestamp(start)
+        end = None if end is None else pd.Timestamp(end)
+
+        filters = []
+        if start is not None:
+            filters.append(('Dates', '>=', start.to_pydatetime()))
+        if end is not None:
+            filters.append(('Dates', '<=', end.to_pydatetime()))
+
+        frame_list = []
+        for part in meta['parts']:
+            if start is not None and pd.Timestamp(part['end']) < start:
+                continue
+            if end is not None and pd.Timestamp(part['start']) > end:
+                continue
+            path = os.path.join(self.part_dir, part['file'])
+            part_columns = None
+            if columns is not None:
+                schema_names = pq.read_schema(path).names
+                part_columns = ['Dates'] + [c for c in columns if c in schema_names]
+            table = pq.read_table(path, columns = part_columns, filters = filters or None)
+            frame_list.append(table.to_pandas())
+
+        if len(frame_list) == 0:
+            return pd.DataFrame(columns = columns, index = pd.DatetimeIndex([], name = 'Dates'), dtype = 'float64')
+
+        tr = pd.concat(frame_list, axis = 0, sort = False).set_index('Dates')
+        tr = tr.sort_index(kind = 'mergesort')
+        # a date can be split over parts when some etfs were ingested later
+        if tr.index.has_duplicates:
+            tr = tr.groupby(level = 0).first()
+        if columns is not None:
+            tr = tr.reindex(columns = columns)
+
+        return tr
+
+    # the returns one 'freq' period ('A' years, 'Q', 'M') at a time, each
+    # chunk a read() of its dates
+    def read_chunks(self, start = None, end = None, columns = None, freq = 'A'):
+        parts = self._read_meta()['parts']
+        if len(parts) == 0:
+            return
+        first = min(pd.Timestamp(part['start']) for part in parts)
+        last = max(pd.Timestamp(part['end']) for part in parts)
+        first = first if start is None else max(first, pd.Timestamp(start))
+        last = last if end is None else min(last, pd.Timestamp(end))
+
+        for period in pd.period_range(first, last, freq = freq):
+            tr = self.read(max(first, period.start_time), min(last, period.end_time.normalize()), columns)
+            if len(tr) > 0:
+                yield tr
+
+    # rewrites all parts into a single file
+    def compact(self):
+        tr = self.read()
+        meta = self._read_meta()
+        if len(meta['parts']) <= 1:
+            return
+
+        old_files = [part['file'] for part in meta['parts']]
+        meta['parts'] = [self._write_part(meta, tr)]
+        self._write_meta(meta)
+        for old_file in old_files:
+            os.remove(os.path.join(self.part_dir, old_file))
+
+
+###3
+# 'etf_daily_return.csv' dates are day first
+ETF_DATE_FORMAT = '%d/%m/%Y'
+
+
+# every dtype has its own files, so that each checks its own csv signature
+def _sidecar_paths(file_name_etf, dtype):
+    name = np.dtype(dtype).name
+    return {
+        'values': '{}.{}.npy'.format(file_name_etf, name),
+        'dates': '{}.{}.dates.npy'.format(file_name_etf, name),
+        'meta': '{}.{}.meta.json'.format(file_name_etf, name)
+        }
+
+
+def _csv_signature(file_name_etf):
+    stat = os.stat(file_name_etf)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _save_npy(path, arr):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+# Reads the daily etf return csv with an explicit date format and dtypes.
+#   float32: downcast the returns to float32
+#   sidecar: keep the parsed arrays next to the csv as .npy files and
+#            memory-map them on later loads for as long as the csv is unchanged
+def read_etf_daily_return(file_name_etf = 'etf_daily_return.csv', float32 = False, sidecar = True):
+    dtype = np.float32 if float32 else np.float64
+    paths = _sidecar_paths(file_name_etf, dtype)
+    signature = _csv_signature(file_name_etf)
+
+    if sidecar and os.path.exists(paths['meta']):
+        with open(paths['meta']) as f:
+            meta = json.load(f)
+        if meta['signature'] == signature and os.path.exists(paths['values']):
+            values = np.load(paths['values'], mmap_mode = 'r')
+            dates = np.load(paths['dates'], mmap_mode = 'r')
+            index = pd.DatetimeIndex(dates.view('datetime64[ns]'), name = 'Dates')
+            return pd.DataFrame(values, index = index, columns = meta['columns'], copy = False)
+
+    columns = list(pd.read_csv(file_name_etf, nrows = 0).columns)
+    col_dtype = {c: dtype for c in columns if c != 'Dates'}
+    col_dtype['Dates'] = str
+    df_tr = pd.read_csv(file_name_etf, dtype = col_dtype, engine = 'c')
+    df_tr.index = pd.DatetimeIndex(pd.to_datetime(df_tr.pop('Dates'), format = ETF_DATE_FORMAT), name = 'Dates')
+
+    if sidecar:
+        _save_npy(paths['values'], np.ascontiguousarray(df_tr.values))
+        _save_npy(paths['dates'], df_tr.index.values.astype('datetime64[ns]').view('int64'))
+        meta = {'signature': signature, 'columns': list(df_tr.columns)}
+        tmp_path = paths['meta'] + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, paths['meta'])
+
+    return df_tr
+
+
+# read_etf_daily_return 'chunk_size' rows at a time, for histories too large
+# to load at once (no sidecar)
+#   columns: only these etfs are parsed
+def iter_etf_daily_return(file_name_etf = 'etf_daily_return.csv', chunk_size = 260, columns = None, float32 = False):
+    dtype = np.float32 if float32 else np.float64
+    if columns is None:
+        columns = [c for c in pd.read_csv(file_name_etf, nrows = 0).columns if c != 'Dates']
+    col_dtype = {c: dtype for c in columns}
+    col_dtype['Dates'] = str
+
+    for df_tr in pd.read_csv(file_name_etf, usecols = ['Dates'] + list(columns), dtype = col_dtype, engine = 'c', chunksize = chunk_size):
+        df_tr.index = pd.DatetimeIndex(pd.to_datetime(df_tr.pop('Dates'), format = ETF_DATE_FORMAT), name = 'Dates')
+        yield df_tr[columns]
+
+
+###4
+FF_BASE_URL = 'http://mba.tuck.dartmouth.edu/pages/faculty/ken.french/ftp/'
+
+
+class _FamaFrenchReader(FamaFrenchReader):
+
+    def __init__(self, symbols, base_url, **kwargs):
+        super().__init__(symbols, **kwargs)
+        self.base_url = base_url
+
+    @property
+    def url(self):
+        return self.base_url + self.symbols + '_CSV.zip'
+
+
+# first table of a Fama-French dataset, base_url defaults to FF_BASE_URL
+# retries are left to the caller (see RemoteFetcher)
+def read_famafrench(name, start, base_url = None, session = None):
+    base_url = FF_BASE_URL if base_url is None else base_url
+    ff_reader = _FamaFrenchReader(name, base_url, start = start, retry_count = 0, session = session)
+    try:
+        return ff_reader.read()[0]
+    finally:
+        ff_reader.close()
+
+
+# Spaces out calls so that at most 'max_per_second' start every second,
+# shared by all the threads of a RemoteFetcher.
+class RateLimiter:
+
+    def __init__(self, max_per_second = None):
+        self.interval = 1.0 / max_per_second if max_per_second else 0.0
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        if self.interval == 0.0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_time = max(now, self._next_time)
+            self._next_time = start_time + self.interval
+        if start_time > now:
+            time.sleep(start_time - now)
+
+
+# Runs remote requests concurrently on a thread pool.
+# Every request goes through the rate limiter and is retried with exponential
+# backoff on network errors (OSError, which covers requests and
+# pandas_datareader errors), so one transient failure no longer ends the run.
+class RemoteFetcher:
+
+    def __init__(self, max_workers = 8, max_per_second = 5, max_attempts = 4, backoff = 0.5, max_backoff = 8):
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = RateLimiter(max_per_second)
+
+    def call(self, func, *args):
+        retrying = tenacity.Retrying(
+            stop = tenacity.stop_after_attempt(self.max_attempts),
+            wait = tenacity.wait_exponential(multiplier = self.backoff, max = self.max_backoff),
+            retry = tenacity.retry_if_exception_type(OSError),
+            reraise = True
+            )
+
+        def attempt():
+            self.limiter.wait()
+            return func(*args)
+
+        return retrying(attempt)
+
+    # [func(item) for item in items], run concurrently, results in input order
+    # retry = False runs func as is, for funcs that call self.call themselves
+    def map(self, func, items, retry = True):
+        items = list(items)
+        if len(items) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers = min(self.max_workers, len(items))) as pool:
+            if retry:
+                futures = [pool.submit(self.call, func, item) for item in items]
+            else:
+                futures = [pool.submit(func, item) for item in items]
+            return [f.result() for f in futures]
+
+
+###5
+FACTOR_COLUMNS = ['Mkt-RF', 'SMB', 'HML', 'RMW', 'CMA', 'RF']
+
+
+# Where a DataContext gets its market data from.
+#   daily_returns(): daily etf returns, DatetimeIndex x asset names
+#   factor_returns(): {region: monthly factor frame}, month-end dates and
+#                     FACTOR_COLUMNS, already divided by 100
+#   region_assets(): {region: assets regressed on that region's factors},
+#                    the same regions as factor_returns()
+#   daily_return_chunks(columns): the daily returns of those etfs (None for
+#                                 all) as consecutive frames of about a year,
+#                                 slices of daily_returns() unless the
+#                                 provider can read them a chunk at a time
+class MarketDataProvider(abc.ABC):
+
+    @abc.abstractmethod
+    def daily_returns(self):
+        pass
+
+    def daily_return_chunks(self, columns = None, chunk_size = 260):
+        daily_tr = self.daily_returns()
+        if columns is not None:
+            daily_tr = daily_tr.reindex(columns = columns)
+        for start in range(0, len(daily_tr), chunk_size):
+            yield daily_tr.iloc[start:start + chunk_size]
+
+    @abc.abstractmethod
+    def factor_returns(self):
+        pass
+
+    @abc.abstractmethod
+    def region_assets(self):
+        pass
+
+
+# Market data already on disk, nothing is downloaded.
+#   factor_files: {region: parquet file}, e.g. the files of a FactorCache
+#   price_store: read daily returns from a PriceStore instead of the csv
+class FileProvider(MarketDataProvider):
+
+    def __init__(self, region_assets, factor_files, file_name_etf = 'etf_daily_return.csv', price_store = None):
+        self._region_assets = region_assets
+        self.factor_files = factor_files
+        self.file_name_etf = file_name_etf
+        self.price_store = price_store
+
+    def daily_returns(self):
+        if self.price_store is not None:
+            return self.price_store.read()
+        return read_etf_daily_return(self.file_name_etf)
+
+    def daily_return_chunks(self, columns = None, chunk_size = 260):
+        if self.price_store is not None:
+            return self.price_store.read_chunks(columns = columns)
+        return iter_etf_daily_return(self.file_name_etf, chunk_size, columns)
+
+    def factor_returns(self):
+        return {region: pd.read_parquet(path) for region, path in self.factor_files.items()}
+
+    def region_assets(self):
+        return self._region_assets
+
+
+# Deterministic market of any size for benchmarks and regression tests.
+# Daily factor returns are drawn for every region, asset returns are
+# rf + betas x factors + noise, and the monthly factor sets are the daily ones
+# compounded, so the factor regressions have something to find.
+# Regions are 'us', 'dm', 'em', 'region_3', ... and asset i belongs to
+# region i % n_regions. daily_factors = True returns the daily factor sets,
+# for weekly rebalancing.
+class SyntheticProvider(MarketDataProvider):
+
+    def __init__(self, n_assets = 17, n_months = 240, seed = 0, start = '2000-01-01', n_regions = 3, daily_factors = False):
+        self.daily_factors = daily_factors
+        self.n_assets = n_assets
+        self.n_months = n_months
+        self.regions = (['us', 'dm', 'em'] + ['region_{}'.format(i) for i in range(3, n_regions)])[:n_regions]
+        self.seed = seed
+        self.start = start
+        self._data = None
+
+    def _generate(self):
+        rng = np.random.RandomState(self.seed)
+        month_end = pd.date_range(self.start, periods = self.n_months, freq = 'M')
+        dates = pd.bdate_range(month_end[0] - pd.offsets.MonthBegin(1), month_end[-1])
+        n_days = len(dates)
+
+        # daily Mkt-RF, SMB, HML, RMW, CMA and RF
+        factor_mean = np.array([0.0003, 0.0, 0.0001, 0.0001, 0.0001, 0.0001])
+        factor_vol = np.array([0.010, 0.005, 0.005, 0.003, 0.003, 0.0])
+
+        daily_factors = {}
+        factor_dict = {}
+        for region in self.regions:
+            values = factor_mean + factor_vol * rng.standard_normal((n_days, len(FACTOR_COLUMNS)))
+            daily = pd.DataFrame(values, index = dates, columns = FACTOR_COLUMNS)
+            daily_factors[region] = daily
+            if self.daily_factors:
+                factor_dict[region] = daily
+                continue
+            monthly = np.expm1(np.log1p(daily).groupby(daily.index.to_period('M')).sum())
+            monthly.index = monthly.index.to_timestamp(how = 'end').normalize()
+            factor_dict[region] = monthly
+
+        asset_names = ['Asset {:03d}'.format(i) for i in range(self.n_assets)]
+        region_assets = {region: [] for region in self.regions}
+        returns = np.empty((n_days, self.n_assets))
+        for i, name in enumerate(asset_names):
+            region = self.regions[i % len(self.regions)]
+            region_assets[region].append(name)
+            factors = daily_factors[region].values
+            betas = np.concatenate([rng.uniform(0.2, 1.3, 1), rng.uniform(-0.5, 0.5, 4)])
+            noise = rng.uniform(0.002, 0.01) * rng.standard_normal(n_days)
+            returns[:, i] = factors[:, 5] + factors[:, :5].dot(betas) + noise
+
+        daily_tr = pd.DataFrame(returns, index = pd.DatetimeIndex(dates, name = 'Dates'), columns = asset_names)
+        self._data = (daily_tr, factor_dict, region_assets)
+
+    def daily_returns(self):
+        if self._data is None:
+            self._generate()
+        return self._data[0]
+
+    def factor_returns(self):
+        if self._data is None:
+            self._generate()
+        return self._data[1]
+
+    def region_assets(self):
+        if self._data is None:
+            self._generate()
+        return self._data[2]
+
+
+###6
+# Per-window results of earlier pipeline runs, one folder per account with an
+# .npy file per array and 'meta.json', so a walk-forward run only computes
+# the windows added since. The meta is up to the caller (what the results
+# were computed from, to tell whether they still hold). save removes it
+# before writing the arrays and writes it last, so a save cut short leaves
+# no meta and the next load finds nothing stored.
+class WindowStore:
+
+    def __init__(self, store_dir = 'window_store'):
+        self.store_dir = store_dir
+
+    def path(self, account, name):
+        return os.path.join(self.store_dir, account, name)
+
+    # (meta, {name: array}), or (None, {}) when nothing is stored
+    def load(self, account):
+        meta_path = self.path(account, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None, {}
+        with open(meta_path) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(self.path(account, name + '.npy')) for name in meta['arrays']}
+        return meta, arrays
+
+    def save(self, account, meta, arrays):
+        os.makedirs(os.path.join(self.store_dir, account), exist_ok = True)
+        meta_path = self.path(account, 'meta.json')
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        for name, arr in arrays.items():
+            _save_npy(self.path(account, name + '.npy'), arr)
+
+        meta = dict(meta, arrays = sorted(arrays))
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent = 1)
+        os.replace(meta_path + '.tmp', meta_path)
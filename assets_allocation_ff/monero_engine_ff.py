@@ -0,0 +1,1352 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import cvxpy as cp
+import scipy.cluster.hierarchy as sch
+from scipy.optimize import linear_sum_assignment
+from pypfopt.exceptions import OptimizationError
+
+
+###1
+# column -> region number, for region_lists = [assets of region 0, ...]
+def make_col_region(region_lists):
+    return np.repeat(np.arange(len(region_lists)), [len(asset_list) for asset_list in region_lists])
+
+
+# Excess returns of every asset over the risk-free rate of its region.
+#   asset_m: asset returns, DatetimeIndex x assets
+#   region_lists: [assets of region 0, assets of region 1, ...]
+#   factor_list: [factor frame of region 0, ...], each with an 'RF' column
+# Dates are the sorted inner join of all the indexes. Returns one contiguous
+# frame with the region blocks side by side, and the factor frames cut to the
+# same dates.
+def align_excess_returns(asset_m, region_lists, factor_list):
+    index = asset_m.index.sort_values()
+    for factors in factor_list:
+        index = index.join(factors.index.sort_values(), how = 'inner')
+
+    columns = [i for asset_list in region_lists for i in asset_list]
+    col_region = make_col_region(region_lists)
+
+    factor_list = [factors.loc[index] for factors in factor_list]
+    rf = np.column_stack([factors['RF'].values for factors in factor_list])
+
+    values = asset_m.loc[index, columns].values - rf[:, col_region]
+    asset_rf = pd.DataFrame(np.ascontiguousarray(values), index = index, columns = columns)
+
+    return asset_rf, factor_list
+
+
+###2
+# rebalance frequency -> (pandas period, periods per year, next period end offset)
+PERIOD_DICT = {
+    'W': ('W-FRI', 52, pd.offsets.Week(weekday = 4)),
+    'M': ('M', 12, pd.offsets.MonthEnd(1)),
+    'Q': ('Q-DEC', 4, pd.offsets.QuarterEnd(startingMonth = 3))
+    }
+
+PERIOD_DAYS = {'W': 7, 'M': 31, 'Q': 92}
+
+
+def periods_per_year(freq):
+    return PERIOD_DICT[freq][1]
+
+
+def next_period_end(date, freq):
+    return date + PERIOD_DICT[freq][2]
+
+
+# Compounds returns into weekly ('W'), monthly ('M') or quarterly ('Q') ones
+# with a single grouped sum of log returns. Periods are labelled with their
+# end date (Friday, month end, quarter end).
+def aggregate_returns(tr, freq = 'M'):
+    period_index = tr.index.to_period(PERIOD_DICT[freq][0])
+    agg_tr = np.expm1(np.log1p(tr).groupby(period_index).sum())
+    agg_tr.index = agg_tr.index.to_timestamp(how = 'end').normalize()
+    agg_tr.index.name = tr.index.name
+    return agg_tr
+
+
+# Factor returns at the rebalance frequency.
+# Mkt-RF is compounded as market return minus compounded RF; the long-short
+# factors are compounded like returns. Factors already at that frequency are
+# only relabelled. Raises ValueError if the factors are coarser than freq
+# (weekly rebalancing needs daily or weekly factor sets, the Fama-French
+# monthly sets only support 'M' and 'Q').
+# Periods the factor rows only partly cover are dropped, e.g. monthly factors
+# up to August give no third quarter, see _complete_periods.
+def aggregate_factors(factors, freq = 'M'):
+    spacing = np.median(np.diff(factors.index.values).astype('timedelta64[D]').astype(float))
+    if spacing > PERIOD_DAYS[freq]:
+        raise ValueError('factor data every {:.0f} days is too coarse for freq {!r}'.format(spacing, freq))
+
+    period_index = factors.index.to_period(PERIOD_DICT[freq][0])
+    complete = _complete_periods(factors.index, period_index, freq, spacing)
+    factors = factors[complete]
+    period_index = period_index[complete]
+    if not period_index.has_duplicates:
+        agg_factors = factors.copy()
+        agg_factors.index = period_index.to_timestamp(how = 'end').normalize()
+        return agg_factors
+
+    total = factors.copy()
+    total['Mkt-RF'] = factors['Mkt-RF'] + factors['RF']
+    agg_factors = aggregate_returns(total, freq)
+    agg_factors['Mkt-RF'] = agg_factors['Mkt-RF'] - agg_factors['RF']
+    return agg_factors
+
+
+# Boolean mask of the factor rows in periods they cover completely.
+# Monthly rows need every month of the period. Daily (or weekly) rows only
+# have to reach the first and last business day of the first and last
+# period, within one row spacing; a holiday there drops that period until
+# the next one starts.
+def _complete_periods(dates, period_index, freq, spacing):
+    if spacing > PERIOD_DAYS['W']:
+        n_months = pd.Series(dates.to_period('M'), index = dates).groupby(period_index).nunique()
+        complete = n_months.index[n_months == 12 // periods_per_year(freq)]
+        return period_index.isin(complete)
+
+    complete = np.ones(len(dates), dtype = bool)
+    bday = pd.offsets.BDay()
+    first_day = bday.rollforward(period_index[0].start_time) + pd.Timedelta(days = spacing - 1)
+    if dates[0] > first_day:
+        complete &= period_index != period_index[0]
+    if dates[-1] < bday.rollback(period_index[-1].end_time.normalize()):
+        complete &= period_index != period_index[-1]
+    return complete
+
+
+###3
+FACTOR_NAMES = ['Mkt-RF', 'SMB', 'HML', 'RMW', 'CMA']
+
+# alpha: (n_windows x n_assets), beta: (n_windows x n_assets x k),
+# fitted_mean: (n_windows x n_assets) mean in-sample fitted value,
+# fitted: (n_windows x window x n_assets) in-sample fitted values or None
+RollingRegression = namedtuple('RollingRegression', ['alpha', 'beta', 'fitted_mean', 'fitted'])
+
+# Expected excess returns of a pipeline run, one row per rolling window.
+# mu: (n_windows x n_assets) mean fitted excess return (alpha + beta x mean factors)
+# alpha, beta: factor exposures as in RollingRegression, or None
+# dates: end date of each window, columns: asset names
+ExpectedReturns = namedtuple('ExpectedReturns', ['mu', 'alpha', 'beta', 'dates', 'columns'])
+
+
+# read-only (n_windows x window x ...) view of arr, window a = arr[a:a+window]
+def rolling_view(arr, window, n_windows):
+    shape = (n_windows, window) + arr.shape[1:]
+    strides = (arr.strides[0],) + arr.strides
+    return np.lib.stride_tricks.as_strided(arr, shape = shape, strides = strides, writeable = False)
+
+
+# OLS with intercept of every asset on its region's factors, for every
+# rolling window at once.
+#   asset_rf: (T x n) excess returns
+#   factor_arrays: [(T x k) factors of region 0, ...]
+#   col_region: region number of each asset column
+# Assets of a region share one factor matrix, so each region is a single
+# batched solve of the demeaned normal equations over all windows.
+def rolling_factor_regression(asset_rf, factor_arrays, col_region, window, n_windows, fitted = False):
+    asset_rf = np.ascontiguousarray(asset_rf, dtype = np.float64)
+    n = asset_rf.shape[1]
+    k = factor_arrays[0].shape[1]
+
+    alpha = np.empty((n_windows, n))
+    beta = np.empty((n_windows, n, k))
+    fitted_mean = np.empty((n_windows, n))
+    fitted_values = np.empty((n_windows, window, n)) if fitted else None
+
+    for r, factors in enumerate(factor_arrays):
+        cols = np.flatnonzero(col_region == r)
+        if len(cols) == 0:
+            continue
+
+        x = rolling_view(np.ascontiguousarray(factors, dtype = np.float64), window, n_windows)
+        y = rolling_view(np.ascontiguousarray(asset_rf[:, cols]), window, n_windows)
+        x_mean = x.mean(axis = 1)
+        y_mean = y.mean(axis = 1)
+        x_c = x - x_mean[:, None, :]
+        y_c = y - y_mean[:, None, :]
+
+        xtx = np.einsum('wtk,wtj->wkj', x_c, x_c)
+        xty = np.einsum('wtk,wtn->wkn', x_c, y_c)
+        b = np.linalg.solve(xtx, xty)
+        a = y_mean - np.einsum('wk,wkn->wn', x_mean, b)
+
+        alpha[:, cols] = a
+        beta[:, cols, :] = b.transpose(0, 2, 1)
+        fitted_mean[:, cols] = a + np.einsum('wk,wkn->wn', x_mean, b)
+        if fitted:
+            fitted_values[:, :, cols] = a[:, None, :] + np.einsum('wtk,wkn->wtn', x, b)
+
+    return RollingRegression(alpha, beta, fitted_mean, fitted_values)
+
+
+# (n_windows x window x n) in-sample fitted values from the coefficients
+def fitted_values(regression, factor_arrays, col_region, window):
+    n_windows, n = regression.alpha.shape
+    fitted = np.empty((n_windows, window, n))
+    for r, factors in enumerate(factor_arrays):
+        cols = np.flatnonzero(col_region == r)
+        if len(cols) == 0:
+            continue
+        x = rolling_view(np.ascontiguousarray(factors, dtype = np.float64), window, n_windows)
+        fitted[:, :, cols] = regression.alpha[:, None, cols] + np.einsum('wtk,wnk->wtn', x, regression.beta[:, cols, :])
+    return fitted
+
+
+###4
+# Rolling OLS with intercept of one region's assets, kept up to date one row
+# at a time.
+# The uncentred cross products X'X and X'Y of the current window (X with a
+# leading constant column) are updated in O(k^2 + k n) per row by adding the
+# newest row and removing the oldest, so a new window costs the same whatever
+# the window length. To stop rounding errors from building up they are
+# rebuilt from the buffered window every 'refactor_every' rows, and whenever
+# X'X is too badly conditioned to solve safely.
+class RollingOLS:
+
+    def __init__(self, window, k, n, refactor_every = 60, max_cond = 1e10):
+        self.window = window
+        self.refactor_every = refactor_every
+        self.max_cond = max_cond
+        self.xtx = np.zeros((k + 1, k + 1))
+        self.xty = np.zeros((k + 1, n))
+        self.n_refactor = 0
+        self._x = np.zeros((window, k + 1))
+        self._y = np.zeros((window, n))
+        self._count = 0
+        self._since_refactor = 0
+
+    def is_full(self):
+        return self._count >= self.window
+
+    # adds the newest row and drops the oldest once the window is full
+    def push(self, x_row, y_row):
+        pos = self._count % self.window
+        if self._count >= self.window:
+            old_x = self._x[pos]
+            self.xtx -= np.outer(old_x, old_x)
+            self.xty -= np.outer(old_x, self._y[pos])
+
+        self._x[pos, 0] = 1.0
+        self._x[pos, 1:] = x_row
+        self._y[pos] = y_row
+        self.xtx += np.outer(self._x[pos], self._x[pos])
+        self.xty += np.outer(self._x[pos], self._y[pos])
+        self._count += 1
+
+        self._since_refactor += 1
+        if self._since_refactor >= self.refactor_every:
+            self.refactor()
+
+    def refactor(self):
+        rows = min(self._count, self.window)
+        self.xtx = self._x[:rows].T.dot(self._x[:rows])
+        self.xty = self._x[:rows].T.dot(self._y[:rows])
+        self._since_refactor = 0
+        self.n_refactor += 1
+
+    # (alpha (n), beta (n x k), fitted_mean (n)) of the current window
+    def solve(self):
+        if np.linalg.cond(self.xtx) > self.max_cond:
+            self.refactor()
+            coef = np.linalg.lstsq(self._x, self._y, rcond = None)[0]
+        else:
+            coef = np.linalg.solve(self.xtx, self.xty)
+
+        alpha = coef[0]
+        beta = coef[1:].T
+        x_mean = self.xtx[0, 1:] / self.xtx[0, 0]
+        return alpha, beta, alpha + beta.dot(x_mean)
+
+
+# Same result as rolling_factor_regression (without fitted values), computed
+# by sliding one RollingOLS per region over the rows.
+# state: RollingOLS objects of a previous call that already hold the rows
+#        before 'start', to only add the windows of newly arrived rows
+# returns (RollingRegression for windows start .. n_windows - 1, state)
+def incremental_factor_regression(asset_rf, factor_arrays, col_region, window, n_windows,
+                                  start = 0, state = None, refactor_every = 60):
+    asset_rf = np.asarray(asset_rf, dtype = np.float64)
+    n = asset_rf.shape[1]
+    k = factor_arrays[0].shape[1]
+    region_cols = [np.flatnonzero(col_region == r) for r in range(len(factor_arrays))]
+
+    if state is None:
+        state = [RollingOLS(window, k, len(cols), refactor_every) for cols in region_cols]
+        first_row = start
+    else:
+        first_row = start + window - 1
+
+    n_out = n_windows - start
+    alpha = np.empty((n_out, n))
+    beta = np.empty((n_out, n, k))
+    fitted_mean = np.empty((n_out, n))
+
+    for t in range(first_row, n_windows + window - 1):
+        a = t - window + 1
+        for r, cols in enumerate(region_cols):
+            if len(cols) == 0:
+                continue
+            state[r].push(factor_arrays[r][t], asset_rf[t, cols])
+            if a >= start:
+                alpha[a - start, cols], beta[a - start, cols, :], fitted_mean[a - start, cols] = state[r].solve()
+
+    return RollingRegression(alpha, beta, fitted_mean, None), state
+
+
+###5
+# Ledoit-Wolf shrinkage towards the Sharpe single-factor matrix (Ledoit and
+# Wolf 2001) for every rolling window at once, the same estimate as
+# pypfopt risk_models.risk_matrix(method="ledoit_wolf_single_factor",
+# returns_data=True, frequency=frequency).
+# Returns the (n_windows x n x n) annualised covariances and the
+# (n_windows) shrinkage constants.
+def ledoit_wolf_single_factor(asset_rf, window, n_windows, frequency = 12):
+    x = rolling_view(np.ascontiguousarray(np.nan_to_num(asset_rf), dtype = np.float64), window, n_windows)
+    t = window
+    n = x.shape[2]
+    diag = np.arange(n)
+
+    # moments shared by the whole estimate
+    xm = x - x.mean(axis = 1)[:, None, :]
+    xmkt = xm.mean(axis = 2)
+    sample = np.einsum('wti,wtj->wij', xm, xm) / t
+    betas = np.einsum('wti,wt->wi', xm, xmkt) / t
+    varmkt = np.einsum('wt,wt->w', xmkt, xmkt) / t
+
+    target = betas[:, :, None] * betas[:, None, :] / varmkt[:, None, None]
+    target[:, diag, diag] = sample[:, diag, diag]
+
+    # shrinkage constant
+    c = ((sample - target) ** 2).sum(axis = (1, 2))
+    y = xm ** 2
+    yty = np.einsum('wti,wtj->wij', y, y) / t
+    p = yty.sum(axis = (1, 2)) - (sample ** 2).sum(axis = (1, 2))
+
+    sample_diag = sample[:, diag, diag]
+    rdiag = (y ** 2).sum(axis = (1, 2)) / t - (sample_diag ** 2).sum(axis = 1)
+    z = xm * xmkt[:, :, None]
+    v1 = np.einsum('wti,wtj->wij', y, z) / t - betas[:, :, None] * sample
+    roff1 = (np.einsum('wij,wj->w', v1, betas) - (v1[:, diag, diag] * betas).sum(axis = 1)) / varmkt
+    v3 = np.einsum('wti,wtj->wij', z, z) / t - varmkt[:, None, None] * sample
+    roff3 = (np.einsum('wij,wi,wj->w', v3, betas, betas) - (v3[:, diag, diag] * betas ** 2).sum(axis = 1)) / varmkt ** 2
+    r = rdiag + 2 * roff1 - roff3
+
+    delta = np.clip((p - r) / c / t, 0, 1)
+    cov = (delta[:, None, None] * target + (1 - delta[:, None, None]) * sample) * frequency
+
+    return _fix_nonpositive_semidefinite(cov), delta
+
+
+# spectral fix of the windows whose covariance is not positive semidefinite,
+# as pypfopt risk_models.fix_nonpositive_semidefinite
+def _fix_nonpositive_semidefinite(cov):
+    eye = 1e-16 * np.eye(cov.shape[1])
+    try:
+        np.linalg.cholesky(cov + eye)
+        return cov
+    except np.linalg.LinAlgError:
+        pass
+
+    for a in range(cov.shape[0]):
+        try:
+            np.linalg.cholesky(cov[a] + eye)
+        except np.linalg.LinAlgError:
+            q, v = np.linalg.eigh(cov[a])
+            cov[a] = (v * np.where(q > 0, q, 0)).dot(v.T)
+    return cov
+
+
+###6
+# cov: (n x n) sample covariance (ddof 1), corr: (n x n) correlation,
+# dist: (n x n) correlation distance ((1 - corr) / 2) ** .5
+RollingMatrices = namedtuple('RollingMatrices', ['cov', 'corr', 'dist'])
+
+
+# Rolling covariance and correlation of the asset returns, kept up to date
+# one row at a time.
+# The column sums and the cross products of the current window are taken
+# around a fixed shift (the mean of the last recomputed window) to keep the
+# cancellation small, and updated in O(n^2) per row by adding the newest row
+# and removing the oldest. They are rebuilt from the buffered window every
+# 'recompute_every' rows.
+class RollingMoments:
+
+    def __init__(self, window, n, recompute_every = 60):
+        self.window = window
+        self.recompute_every = recompute_every
+        self.sum = np.zeros(n)
+        self.cross = np.zeros((n, n))
+        self.n_recompute = 0
+        self._rows = np.zeros((window, n))
+        self._shift = np.zeros(n)
+        self._count = 0
+        self._since_recompute = 0
+
+    def is_full(self):
+        return self._count >= self.window
+
+    # adds the newest row and drops the oldest once the window is full
+    def push(self, row):
+        pos = self._count % self.window
+        if self._count >= self.window:
+            old = self._rows[pos] - self._shift
+            self.sum -= old
+            self.cross -= np.outer(old, old)
+
+        self._rows[pos] = row
+        new = self._rows[pos] - self._shift
+        self.sum += new
+        self.cross += np.outer(new, new)
+        self._count += 1
+
+        self._since_recompute += 1
+        if self._since_recompute >= self.recompute_every:
+            self.recompute()
+
+    def recompute(self):
+        rows = self._rows[:min(self._count, self.window)]
+        self._shift = rows.mean(axis = 0)
+        centred = rows - self._shift
+        self.sum = centred.sum(axis = 0)
+        self.cross = centred.T.dot(centred)
+        self._since_recompute = 0
+        self.n_recompute += 1
+
+    def cov(self):
+        m = min(self._count, self.window)
+        mean = self.sum / m
+        return (self.cross - m * np.outer(mean, mean)) / (m - 1)
+
+    def matrices(self):
+        cov = self.cov()
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            sd = np.sqrt(np.diag(cov))
+            corr = np.clip(cov / np.outer(sd, sd), -1, 1)
+        np.fill_diagonal(corr, 1)
+        return RollingMatrices(cov, corr, ((1 - corr) / 2.) ** .5)
+
+
+# Yields (a, RollingMatrices of window a) for the windows start .. n_windows - 1
+# of asset_rf (T x n), window a covering rows a .. a + window - 1, so the
+# matrices never have to be held for all the windows at once.
+def rolling_matrices(asset_rf, window, n_windows, start = 0, recompute_every = 60):
+    asset_rf = np.asarray(asset_rf, dtype = np.float64)
+    moments = RollingMoments(window, asset_rf.shape[1], recompute_every)
+    for t in range(start, n_windows + window - 1):
+        moments.push(asset_rf[t])
+        if moments.is_full():
+            yield t - window + 1, moments.matrices()
+
+
+###7
+# Single-linkage hierarchical clustering of the assets for every rolling
+# window, cut into n_clusters clusters.
+# As the original stage, the linkage is run on the rows of the distance
+# matrix (each asset's distances to all the assets) as observations.
+# stable = True renumbers each window's clusters to best match the previous
+# window's, so the same cluster keeps its number over time.
+# cache: ClusterCache to skip the windows whose distances did not move
+# start: first window to cluster, prev_labels: labels of the window before it
+#        (from an earlier run) for the stable numbering
+# Returns an ((n_windows - start) x n) int8 label matrix.
+def cluster_labels(asset_rf, window, n_windows, n_clusters = 8, stable = True, cache = None, start = 0, prev_labels = None):
+    labels = np.empty((n_windows - start, np.shape(asset_rf)[1]), dtype = np.int8)
+    if cache is not None:
+        cache.reset()
+    for a, matrices in rolling_matrices(asset_rf, window, n_windows, start):
+        i = a - start
+        prev = labels[i - 1] if i > 0 else prev_labels
+        if cache is not None and cache.unchanged(matrices.dist):
+            labels[i] = prev
+            continue
+        link = sch.linkage(matrices.dist, 'single')
+        labels[i] = sch.cut_tree(link, n_clusters)[:, 0]
+        if stable and prev is not None:
+            labels[i] = relabel_clusters(labels[i], prev, n_clusters)
+        if cache is not None:
+            cache.store(matrices.dist)
+    return labels
+
+
+# Renumbers the clusters of 'labels' so that they overlap the most with the
+# clusters of 'prev_labels' (Hungarian matching on the contingency table).
+def relabel_clusters(labels, prev_labels, n_clusters):
+    overlap = np.bincount(prev_labels.astype(np.intp) * n_clusters + labels.astype(np.intp),
+                          minlength = n_clusters * n_clusters).reshape(n_clusters, n_clusters)
+    prev_id, new_id = linear_sum_assignment(-overlap)
+    mapping = np.empty(n_clusters, dtype = labels.dtype)
+    mapping[new_id] = prev_id
+    return mapping[labels]
+
+
+# (... x n_clusters x n) 0/1 matrices M with M[c, j] = 1 when asset j is in
+# cluster c, so that M.dot(w) are the cluster weights of w
+def cluster_membership(labels, n_clusters = 8):
+    return (labels[..., None, :] == np.arange(n_clusters)[:, None]).astype(np.float64)
+
+
+# 'cluster_0' .. names of the labels, as an array of the labels' shape
+def cluster_names(labels, n_clusters = 8):
+    names = np.array(['cluster_{}'.format(c) for c in range(n_clusters)], dtype = object)
+    return names[labels]
+
+
+###8
+# Change detection between consecutive windows of the clustering stage.
+# unchanged(dist) is True when no distance moved more than 'tol' since the
+# last window that was clustered (not just the previous window, so slow drift
+# cannot add up unnoticed), and the clustering can be skipped. tol = 0 only
+# skips exact repeats, which gives the same labels as no cache.
+# membership(labels) returns the previous window's constraint matrix itself
+# while the labels stay the same.
+class ClusterCache:
+
+    def __init__(self, tol = 0.0, n_clusters = 8):
+        self.tol = tol
+        self.n_clusters = n_clusters
+        self.n_windows = 0
+        self.n_linkage_skipped = 0
+        self.n_constraints = 0
+        self.n_constraints_reused = 0
+        self._dist = None
+        self._labels = None
+        self._membership = None
+
+    def unchanged(self, dist):
+        self.n_windows += 1
+        if self._dist is not None and np.abs(dist - self._dist).max() <= self.tol:
+            self.n_linkage_skipped += 1
+            return True
+        return False
+
+    def store(self, dist):
+        self._dist = dist
+
+    # forgets the last window (not the counts), before a new series of windows
+    def reset(self):
+        self._dist = None
+        self._labels = None
+        self._membership = None
+
+    def membership(self, labels):
+        self.n_constraints += 1
+        if self._labels is not None and np.array_equal(labels, self._labels):
+            self.n_constraints_reused += 1
+        else:
+            self._labels = labels.copy()
+            self._membership = cluster_membership(labels, self.n_clusters)
+        return self._membership
+
+    def stats(self):
+        return {
+            'windows': self.n_windows,
+            'linkage_skipped': self.n_linkage_skipped,
+            'linkage_hit_rate': self.n_linkage_skipped / max(self.n_windows, 1),
+            'constraints': self.n_constraints,
+            'constraints_reused': self.n_constraints_reused,
+            'constraints_hit_rate': self.n_constraints_reused / max(self.n_constraints, 1)
+            }
+
+
+###9
+# Weights below cutoff set to 0 and the rest rounded, as pypfopt's
+# clean_weights() (works on any array of weights)
+def clean_weights(weights, cutoff = 1e-4, rounding = 5):
+    weights = np.where(np.abs(weights) < cutoff, 0, weights)
+    return np.round(weights, rounding) + 0.0
+
+
+# factor L with L L' = cov, also when cov is only positive semidefinite,
+# always a plain ndarray (cvxpy rejects the np.memmap np.linalg returns for
+# the memory-mapped covariances of the process pool)
+def cov_factor(cov):
+    cov = np.asarray(cov, dtype = np.float64)
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        q, v = np.linalg.eigh(cov)
+        return v * np.sqrt(np.clip(q, 0, None))
+
+
+# (F, scale) with scale F F' = cov, the eigendecomposition cvxpy's quad_form
+# puts into the problem, so that a problem with F and scale as Parameters
+# hands the solver the same numbers as pypfopt's (a plain ndarray, see
+# cov_factor)
+def scaled_cov_factor(cov):
+    cov = np.asarray(cov, dtype = np.float64)
+    q, v = np.linalg.eigh(cov)
+    scale = np.abs(q).max()
+    return v * np.sqrt(np.clip(q / scale, 0, None)), scale
+
+
+# Long-only maximum return portfolios under volatility targets and cluster
+# weight bounds, the problem of EfficientFrontier.efficient_risk with
+# add_sector_constraints, built once as a parametrised cvxpy problem.
+# For each of the n_targets targets k:
+#   min -mu'w_k  s.t.  0 <= w_k <= 1, lower <= M w_k <= upper_k,
+#                      scale |F'w_k|^2 <= target_vol_k^2, sum(w_k) = 1
+# in the order and with the covariance factor (scaled_cov_factor) of
+# pypfopt's problem, so a one-target problem is solved to the same weights.
+# The targets share mu, F and the membership matrix M. All the inputs are
+# cvxpy Parameters, so the problem is canonicalised once and every later
+# solve only updates the parameter values. Several targets can be stacked
+# into one problem, but the solver tolerance then applies to their summed
+# objective, so solve_frontier_windows solves one target per call.
+# warm_start is passed on to the solver; ECOS, the default, ignores it.
+# solver: solver name or names in priority order, see solver_priority
+# solver_options: {solver name: keyword arguments for that solver}
+# log: SolveLog getting one record per solve attempt
+class FrontierSolver:
+
+    def __init__(self, n, n_targets = 1, n_clusters = 8, solver = None, solver_options = None, warm_start = True, log = None):
+        self.n_targets = n_targets
+        self.solvers = solver_priority(solver)
+        self.warm_start = warm_start
+        self.solver_options = solver_options or {}
+        self.log = log
+        self.min_volatility = None
+        self.w = cp.Variable((n_targets, n))
+        self.mu = cp.Parameter(n)
+        self.factor = cp.Parameter((n, n))
+        self.scale = cp.Parameter(nonneg = True)
+        self.target_variance = cp.Parameter(n_targets, nonneg = True)
+        self.membership = cp.Parameter((n_clusters, n))
+        self.lower = cp.Parameter((n_targets, n_clusters))
+        self.upper = cp.Parameter((n_targets, n_clusters))
+        self._membership = None
+
+        cluster_wgt = self.w @ self.membership.T
+        constraints = [
+            self.w >= 0,
+            self.w <= 1,
+            cluster_wgt <= self.upper,
+            cluster_wgt >= self.lower
+            ]
+        constraints += [self.scale * cp.sum_squares(self.w[k] @ self.factor) <= self.target_variance[k] for k in range(n_targets)]
+        constraints.append(cp.sum(self.w, axis = 1) == 1)
+        self.problem = cp.Problem(cp.Minimize(-cp.sum(self.w @ self.mu)), constraints)
+
+    # expected returns (n), covariance (n x n) and cluster membership
+    # matrix (n_clusters x n) of the next window; the membership is only
+    # copied into the problem when it is not the same array as the last one
+    def set_window(self, mu, cov, membership):
+        self.mu.value = np.asarray(mu, dtype = np.float64)
+        self.factor.value, self.scale.value = scaled_cov_factor(cov)
+        self.min_volatility = np.sqrt(1 / np.sum(np.linalg.pinv(cov)))
+        if membership is not self._membership:
+            self.membership.value = np.asarray(membership, dtype = np.float64)
+            self._membership = membership
+
+    # (n_targets x n) raw weights of the window set last, from the first
+    # solver in priority order that solves the problem
+    #   target_volatility: n_targets targets
+    #   lower, upper: cluster bounds, the same for all targets (n_clusters)
+    #                 or one row per target (n_targets x n_clusters)
+    #   window: window number for the log
+    def solve(self, target_volatility, lower, upper, window = None):
+        target_volatility = np.broadcast_to(np.asarray(target_volatility, dtype = np.float64), (self.n_targets,))
+        if target_volatility.min() < self.min_volatility:
+            raise ValueError(
+                "The minimum volatility is {:.3f}. Please use a higher target_volatility".format(self.min_volatility))
+
+        self.target_variance.value = target_volatility ** 2
+        self.lower.value = np.broadcast_to(np.asarray(lower, dtype = np.float64), self.lower.shape).copy()
+        self.upper.value = np.broadcast_to(np.asarray(upper, dtype = np.float64), self.upper.shape).copy()
+        failures = []
+        for name in self.solvers:
+            start = time.perf_counter()
+            try:
+                self.problem.solve(solver = name, warm_start = self.warm_start, **self.solver_options.get(name, {}))
+                status, stats = self.problem.status, self.problem.solver_stats
+            except cp.error.SolverError:
+                status, stats = 'solver_error', None
+            if self.log is not None:
+                self.log.record(
+                    window = window,
+                    target = target_volatility[0] if self.n_targets == 1 else None,
+                    n_targets = self.n_targets,
+                    solver = name if name is not None else getattr(stats, 'solver_name', None),
+                    status = status,
+                    iterations = getattr(stats, 'num_iters', None),
+                    solve_time = getattr(stats, 'solve_time', None),
+                    wall_time = time.perf_counter() - start
+                    )
+            if status in {'optimal', 'optimal_inaccurate'}:
+                return self.w.value.round(16) + 0.0
+            failures.append('{}: {}'.format(name, status))
+        raise OptimizationError('No solver succeeded ({})'.format(', '.join(failures)))
+
+
+# (stop - start x n_targets x n) cleaned weights of the windows start ..
+# stop - 1, one FrontierSolver re-solved window after window.
+#   mu: (n_windows x n) annualised expected returns
+#   cov: (n_windows x n x n) annualised covariances
+#   membership: (n_windows x n_clusters x n) cluster membership matrices
+#   target_volatility: (n_targets) targets
+#   lower: (n_clusters) lower cluster bounds
+#   upper: (n_targets x n_clusters) upper cluster bounds of each target
+# Each target is its own solve of the same one-target problem, with only
+# the target variance and the upper bounds updated in between, so the
+# cleaned weights are those of pypfopt's clean_weights().
+# Warm starts would make a window's weights depend on the problem solved
+# before it, so they are off by default to give the same weights however the
+# windows are split into chunks.
+# solver, log: as in FrontierSolver
+# window_offset: number of window 0 of the arrays, logged windows are
+#                window_offset + a
+def solve_frontier_windows(mu, cov, membership, target_volatility, lower, upper,
+                           start = 0, stop = None, solver = None, warm_start = False, log = None, window_offset = 0):
+    if stop is None:
+        stop = len(mu)
+    n_targets = len(target_volatility)
+    n_clusters, n = np.shape(membership[start])
+    frontier = FrontierSolver(n, 1, n_clusters, solver, warm_start = warm_start, log = log)
+
+    weights = np.empty((stop - start, n_targets, n))
+    for a in range(start, stop):
+        frontier.set_window(mu[a], cov[a], membership[a])
+        raw_wgt = [frontier.solve(target_volatility[i], lower, upper[i], window = window_offset + a)[0] for i in range(n_targets)]
+        weights[a - start] = clean_weights(np.asarray(raw_wgt))
+    return weights
+
+
+###10
+# Same result as solve_frontier_windows for all the windows, with the windows
+# split into chunks of chunk_size solved in 'workers' processes.
+# mu, cov and membership are written once to memory-mapped files in a
+# temporary directory that every worker maps read-only, so only the file
+# names and the chunk bounds are sent to the workers. The chunks (and their
+# log records) are put back in window order.
+def parallel_frontier_windows(mu, cov, membership, target_volatility, lower, upper,
+                              solver = None, workers = None, chunk_size = None, log = None, window_offset = 0):
+    n_windows = len(mu)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if chunk_size is None:
+        chunk_size = max(1, -(-n_windows // (4 * workers)))
+
+    tmp_dir = tempfile.mkdtemp(prefix = 'monero_frontier_')
+    try:
+        arrays = {}
+        for name, arr in [('mu', mu), ('cov', cov), ('membership', membership)]:
+            arrays[name] = _write_memmap(os.path.join(tmp_dir, name + '.dat'), arr)
+
+        tasks = [(arrays, start, min(start + chunk_size, n_windows), target_volatility, lower, upper, solver, log is not None, window_offset)
+                 for start in range(0, n_windows, chunk_size)]
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            chunks = list(pool.map(_solve_frontier_chunk, tasks))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    if log is not None:
+        for _, records in chunks:
+            log.extend(records)
+    return np.concatenate([weights for weights, _ in chunks])
+
+
+def _write_memmap(path, arr):
+    arr = np.asarray(arr, dtype = np.float64)
+    mm = np.memmap(path, dtype = np.float64, mode = 'w+', shape = arr.shape)
+    mm[:] = arr
+    mm.flush()
+    del mm
+    return path, arr.shape
+
+
+def _solve_frontier_chunk(task):
+    arrays, start, stop, target_volatility, lower, upper, solver, logged, window_offset = task
+    mu, cov, membership = [np.memmap(path, dtype = np.float64, mode = 'r', shape = shape)
+                           for path, shape in [arrays['mu'], arrays['cov'], arrays['membership']]]
+    log = SolveLog() if logged else None
+    weights = solve_frontier_windows(mu, cov, membership, target_volatility, lower, upper, start, stop, solver, log = log,
+                                     window_offset = window_offset)
+    return weights, log.records if logged else None
+
+
+###11
+# ValueError when a target is below the minimum (unconstrained) volatility of
+# a window, the check of EfficientFrontier.efficient_risk
+def check_min_volatility(cov, target_volatility):
+    for c in cov:
+        min_volatility = np.sqrt(1 / np.sum(np.linalg.pinv(c)))
+        if np.min(target_volatility) < min_volatility:
+            raise ValueError(
+                "The minimum volatility is {:.3f}. Please use a higher target_volatility".format(min_volatility))
+
+
+# Same problems as solve_frontier_windows (all windows x all targets), solved
+# without cvxpy:
+# 1. one vectorised ADMM run (OSQP-style splitting, min -mu'w with the
+#    constraint rows C = [I; M; 1'; L'] projected onto the weight box, the
+#    cluster bounds, the budget and the volatility ball) for all problems
+#    at once, to a moderate accuracy,
+# 2. an exact polish of each problem from the ADMM active set
+#    (polish_frontier), and
+# 3. FrontierSolver for the few problems the polish cannot settle.
+# returns ((n_windows x n_targets x n) cleaned weights,
+#          (n_windows x n_targets) True where the polish gave the solution)
+# window_offset: as in solve_frontier_windows
+def admm_frontier_windows(mu, cov, membership, target_volatility, lower, upper, solver = None, log = None, window_offset = 0,
+                          max_iter = 300, rho = 0.1, sigma = 1e-6, alpha = 1.6, eps = 1e-6, check_every = 25):
+    mu = np.asarray(mu, dtype = np.float64)
+    cov = np.asarray(cov, dtype = np.float64)
+    membership = np.asarray(membership, dtype = np.float64)
+    target_volatility = np.asarray(target_volatility, dtype = np.float64)
+    lower = np.asarray(lower, dtype = np.float64)
+    upper = np.asarray(upper, dtype = np.float64)
+    n_windows, n = mu.shape
+    n_targets = len(target_volatility)
+
+    check_min_volatility(cov, target_volatility)
+
+    start = time.perf_counter()
+    factor = np.array([cov_factor(c) for c in cov])
+    x, iterations = _admm(mu, cov, factor, membership, target_volatility, lower, upper,
+                          max_iter, rho, sigma, alpha, eps, check_every)
+
+    weights = np.empty_like(x)
+    polished = np.zeros((n_windows, n_targets), dtype = bool)
+    for a in range(n_windows):
+        for k in range(n_targets):
+            w = polish_frontier(x[a, k], mu[a], cov[a], membership[a], lower, upper[k], target_volatility[k])
+            if w is not None:
+                weights[a, k] = w
+                polished[a, k] = True
+    if log is not None:
+        log.record(n_targets = polished.size, solver = 'admm', status = 'polished {}/{}'.format(polished.sum(), polished.size),
+                   iterations = iterations, wall_time = time.perf_counter() - start)
+
+    frontier_one = None
+    for a, k in np.argwhere(~polished):
+        if frontier_one is None:
+            frontier_one = FrontierSolver(n, 1, membership.shape[1], solver, warm_start = False, log = log)
+        frontier_one.set_window(mu[a], cov[a], membership[a])
+        weights[a, k] = frontier_one.solve(target_volatility[k], lower, upper[k], window = window_offset + a)[0]
+
+    return clean_weights(weights), polished
+
+
+# ADMM iterations of admm_frontier_windows,
+# returns ((n_windows x n_targets x n) weights, number of iterations).
+# The targets of a window share its step size rho, so the linear system
+# (sigma I + rho C'C) is inverted once per window; rho is rescaled per window
+# from the ratio of the primal and dual residuals.
+def _admm(mu, cov, factor, membership, target_volatility, lower, upper,
+          max_iter, rho, sigma, alpha, eps, check_every):
+    n_windows, n = mu.shape
+    n_targets = len(target_volatility)
+    rho_eq = 1e3    # relative step of the budget row, an equality
+    factor_t = factor.transpose(0, 2, 1)
+    membership_t = membership.transpose(0, 2, 1)
+    mtm = np.matmul(membership_t, membership)
+    eye = np.eye(n)
+    ones = np.ones((n, n))
+
+    rho = np.full(n_windows, float(rho))
+    kinv = np.linalg.inv(sigma * eye + rho[:, None, None] * (eye + mtm + rho_eq * ones + cov))
+    q = -mu[:, None, :]
+    x = np.zeros((n_windows, n_targets, n))
+    z = [np.zeros((n_windows, n_targets, n)), np.zeros((n_windows, n_targets, len(lower))),
+         np.zeros((n_windows, n_targets, 1)), np.zeros((n_windows, n_targets, n))]
+    y = [np.zeros_like(part) for part in z]
+
+    for it in range(max_iter):
+        r = rho[:, None, None]
+        step = [r, r, r * rho_eq, r]
+        rhs = (sigma * x - q + (step[0] * z[0] - y[0]) + np.matmul(step[1] * z[1] - y[1], membership)
+               + (step[2] * z[2] - y[2]) + np.matmul(step[3] * z[3] - y[3], factor_t))
+        x_tilde = np.matmul(rhs, kinv)
+        c_x = [x_tilde, np.matmul(x_tilde, membership_t), x_tilde.sum(axis = 2, keepdims = True), np.matmul(x_tilde, factor)]
+
+        x = alpha * x_tilde + (1 - alpha) * x
+        relaxed = [alpha * c + (1 - alpha) * old for c, old in zip(c_x, z)]
+        shifted = [h + dual / s for h, dual, s in zip(relaxed, y, step)]
+        ball = np.sqrt((shifted[3] ** 2).sum(axis = 2, keepdims = True))
+        z_new = [
+            np.clip(shifted[0], 0, 1),
+            np.clip(shifted[1], lower, upper[None]),
+            np.ones_like(shifted[2]),
+            shifted[3] * np.minimum(1, target_volatility[None, :, None] / np.maximum(ball, 1e-300))
+            ]
+        y = [dual + s * (h - new) for dual, s, h, new in zip(y, step, relaxed, z_new)]
+        z = z_new
+
+        if (it + 1) % check_every == 0:
+            c_x = [x, np.matmul(x, membership_t), x.sum(axis = 2, keepdims = True), np.matmul(x, factor)]
+            prim = np.max([np.abs(c - part).max(axis = 2) for c, part in zip(c_x, z)], axis = 0)
+            prim_scale = np.max([np.maximum(np.abs(c).max(axis = 2), np.abs(part).max(axis = 2)) for c, part in zip(c_x, z)], axis = 0)
+            c_y = y[0] + np.matmul(y[1], membership) + y[2] + np.matmul(y[3], factor_t)
+            dual = np.abs(q + c_y).max(axis = 2)
+            dual_scale = np.maximum(np.abs(q).max(axis = 2), np.abs(c_y).max(axis = 2))
+            if prim.max() < eps and dual.max() < eps:
+                break
+
+            ratio = np.sqrt((prim / np.maximum(prim_scale, 1e-12)).max(axis = 1)
+                            / np.maximum((dual / np.maximum(dual_scale, 1e-12)).max(axis = 1), 1e-12))
+            update = (ratio > 5) | (ratio < 0.2)
+            if update.any():
+                rho = np.where(update, np.clip(rho * ratio, 1e-6, 1e6), rho)
+                kinv = np.linalg.inv(sigma * eye + rho[:, None, None] * (eye + mtm + rho_eq * ones + cov))
+
+    return x, it + 1
+
+
+# Exact solution of one problem of admm_frontier_windows from an approximate
+# one x, or None.
+# Starting from the constraints x nearly meets, each step solves the KKT
+# system of min 1/2 w'Sw - t mu'w on that face, whose solution is affine in
+# t, and takes the t that puts the portfolio on the volatility target (or the
+# vertex when the face is a single point). The most violated constraint is
+# then added, or the one with the most negative multiplier dropped, until the
+# point is feasible with non-negative multipliers.
+def polish_frontier(x, mu, cov, membership, lower, upper, target_volatility, tol_active = 1e-4, tol = 1e-9):
+    n = len(x)
+    g = np.vstack([-np.eye(n), np.eye(n), -membership, membership])
+    h = np.concatenate([np.zeros(n), np.ones(n), -lower, upper])
+    active = g.dot(x) >= h - tol_active
+
+    for _ in range(2 * len(h)):
+        a = np.vstack([np.ones((1, n)), g[active]])
+        b = np.concatenate([[1.0], h[active]])
+        k = len(b)
+        kkt = np.zeros((n + k, n + k))
+        kkt[:n, :n] = cov
+        kkt[:n, n:] = a.T
+        kkt[n:, :n] = a
+        try:
+            sol = np.linalg.solve(kkt, np.column_stack([np.concatenate([np.zeros(n), b]), np.concatenate([mu, np.zeros(k)])]))
+        except np.linalg.LinAlgError:
+            return None
+        w0, d = sol[:n, 0], sol[:n, 1]
+        lam0, lam_d = sol[n + 1:, 0], sol[n + 1:, 1]
+
+        if np.abs(d).max() <= 1e-12:
+            w, lam = w0, lam_d
+            if w.dot(cov).dot(w) > target_volatility ** 2 + tol:
+                return None
+        else:
+            qa = d.dot(cov).dot(d)
+            qb = 2 * w0.dot(cov).dot(d)
+            qc = w0.dot(cov).dot(w0) - target_volatility ** 2
+            disc = qb * qb - 4 * qa * qc
+            if qa <= 0 or disc < 0:
+                return None
+            t = (-qb + np.sqrt(disc)) / (2 * qa)
+            if t <= 0:
+                return None
+            w, lam = w0 + t * d, lam0 + t * lam_d
+
+        violation = g.dot(w) - h
+        violation[active] = -np.inf
+        if violation.max() > tol:
+            active[np.argmax(violation)] = True
+        elif len(lam) and lam.min() < -tol * max(1, np.abs(lam).max()):
+            active[np.flatnonzero(active)[np.argmin(lam)]] = False
+        else:
+            return w
+    return None
+
+
+
+###12
+# The whole efficient frontier of one constraint set,
+#   w(t) = argmin 1/2 w'Sw - t mu'w  s.t. sum(w) = 1, 0 <= w <= 1,
+#                                         lower <= M w <= upper,  t >= 0,
+# traced once. w(t) is piecewise affine in t: on each segment the active
+# constraints stay the same and w(t) = w0 + t d. A segment ends where an
+# inactive constraint is reached (it joins the active set) or the multiplier
+# of an active one reaches zero (it leaves). The volatility grows along the
+# path, from the minimum variance portfolio at t = 0 to the maximum return
+# portfolio at the end, so the portfolio of any volatility target is found on
+# its segment with one quadratic equation.
+class Frontier:
+
+    def __init__(self, mu, cov, membership, lower, upper, tol = 1e-10, max_segments = 500):
+        mu = np.asarray(mu, dtype = np.float64)
+        membership = np.asarray(membership, dtype = np.float64)
+        lower = np.asarray(lower, dtype = np.float64)
+        upper = np.asarray(upper, dtype = np.float64)
+        self.cov = np.asarray(cov, dtype = np.float64)
+        n = len(mu)
+        g = np.vstack([-np.eye(n), np.eye(n), -membership, membership])
+        h = np.concatenate([np.zeros(n), np.ones(n), -lower, upper])
+
+        w, active = _min_variance_point(self.cov, membership, lower, upper, g, h, tol)
+        t = [0.0]
+        w0 = []
+        d = []
+        for _ in range(max_segments):
+            (w0_s, d_s), (lam0, lam_d) = _kkt_solve(
+                self.cov, g[active], np.column_stack([np.zeros(n), mu]),
+                np.column_stack([np.concatenate([[1.0], h[active]]), np.zeros(active.sum() + 1)]))
+            w0.append(w0_s)
+            d.append(d_s)
+            lam0, lam_d = lam0[1:], lam_d[1:]
+
+            # next event after t[-1]: an inactive constraint reached or an
+            # active multiplier down to zero
+            t_next, row, add = np.inf, None, None
+            slope = g.dot(d_s)
+            reach = ~active & (slope > tol)
+            if reach.any():
+                t_reach = (h[reach] - g[reach].dot(w0_s)) / slope[reach]
+                i = np.argmin(t_reach)
+                t_next, row, add = t_reach[i], np.flatnonzero(reach)[i], True
+            leave = lam_d < -tol
+            if leave.any():
+                t_leave = -lam0[leave] / lam_d[leave]
+                i = np.argmin(t_leave)
+                if t_leave[i] < t_next:
+                    t_next, row, add = t_leave[i], np.flatnonzero(active)[np.flatnonzero(leave)[i]], False
+            if row is None:
+                break
+            t.append(max(t[-1], t_next))
+            active[row] = add
+        else:
+            raise OptimizationError('Frontier not traced in {} segments'.format(max_segments))
+
+        self.t = np.array(t)
+        self.w0 = np.array(w0)
+        self.d = np.array(d)
+        start = self.w0 + self.t[:, None] * self.d
+        self._start_volatility = np.sqrt(np.einsum('si,ij,sj->s', start, self.cov, start))
+        self.min_volatility = self._start_volatility[0]
+        self.max_volatility = self._start_volatility[-1] if np.abs(self.d[-1]).max() <= tol else np.inf
+
+    # (len(target_volatility) x n) frontier portfolios with those
+    # volatilities, the maximum return portfolio for targets above the
+    # highest volatility of the frontier
+    def weights(self, target_volatility):
+        target_volatility = np.atleast_1d(np.asarray(target_volatility, dtype = np.float64))
+        out = np.empty((len(target_volatility), self.w0.shape[1]))
+        for k, vol in enumerate(target_volatility):
+            if vol < self.min_volatility * (1 - 1e-12):
+                raise OptimizationError('The lowest volatility under the constraints is {:.4f}, above the target {:.4f}'.format(
+                    self.min_volatility, vol))
+            # targets just below the minimum (within the tolerance) are the
+            # minimum volatility portfolio, the first segment
+            vol = max(vol, self.min_volatility)
+            s = max(np.searchsorted(self._start_volatility, vol, side = 'right') - 1, 0)
+            w0, d = self.w0[s], self.d[s]
+            qa = d.dot(self.cov).dot(d)
+            if qa <= 0:
+                out[k] = w0 + self.t[s] * d
+                continue
+            qb = 2 * w0.dot(self.cov).dot(d)
+            qc = w0.dot(self.cov).dot(w0) - vol ** 2
+            t = (-qb + np.sqrt(max(qb * qb - 4 * qa * qc, 0))) / (2 * qa)
+            if s + 1 < len(self.t):
+                t = min(t, self.t[s + 1])
+            out[k] = w0 + max(t, self.t[s]) * d
+        return out
+
+
+# Solution (x, multipliers) of the KKT system
+#   [S A'; A 0] [x; lam] = [top; bottom],  A = [1'; g]
+# (top and bottom may have several columns), least squares when singular
+def _kkt_solve(cov, g, top, bottom):
+    n = len(cov)
+    a = np.vstack([np.ones((1, n)), g])
+    k = len(a)
+    kkt = np.zeros((n + k, n + k))
+    kkt[:n, :n] = cov
+    kkt[:n, n:] = a.T
+    kkt[n:, :n] = a
+    rhs = np.concatenate([top, bottom])
+    try:
+        sol = np.linalg.solve(kkt, rhs)
+    except np.linalg.LinAlgError:
+        sol = np.linalg.lstsq(kkt, rhs, rcond = None)[0]
+    if sol.ndim == 1:
+        return sol[:n], sol[n:]
+    return tuple(sol[:n].T), tuple(sol[n:].T)
+
+
+# Minimum variance portfolio under g w <= h and sum(w) = 1, by a primal
+# active-set method. The feasible start spreads the budget over the clusters
+# in proportion to their bound ranges, and evenly inside each cluster.
+# Returns (w, active constraint mask).
+def _min_variance_point(cov, membership, lower, upper, g, h, tol, max_iter = 500):
+    size = membership.sum(axis = 1)
+    if lower.sum() > 1 + tol or upper.sum() < 1 - tol or (size == 0).any():
+        raise OptimizationError('Cluster bounds cannot be met')
+    share = lower + (1 - lower.sum()) * (upper - lower) / (upper - lower).sum()
+    w = membership.T.dot(share / size)
+    active = g.dot(w) >= h - tol
+
+    for _ in range(max_iter):
+        p, lam = _kkt_solve(cov, g[active], -cov.dot(w), np.zeros(active.sum() + 1))
+        if np.abs(p).max() <= tol:
+            lam = lam[1:]
+            if len(lam) == 0 or lam.min() >= -tol:
+                return w, active
+            active[np.flatnonzero(active)[np.argmin(lam)]] = False
+            continue
+
+        # longest step to the face minimum that stays feasible
+        slope = g.dot(p)
+        block = ~active & (slope > tol)
+        alpha, hit = 1.0, None
+        if block.any():
+            ratio = (h[block] - g[block].dot(w)) / slope[block]
+            i = np.argmin(ratio)
+            if ratio[i] < 1:
+                alpha, hit = max(ratio[i], 0.0), np.flatnonzero(block)[i]
+        w = w + alpha * p
+        if hit is not None:
+            active[hit] = True
+    raise OptimizationError('Minimum variance portfolio not found in {} iterations'.format(max_iter))
+
+
+# (n_windows x n_targets x n) cleaned weights of the problems of
+# solve_frontier_windows from traced frontiers, one Frontier per window and
+# distinct row of upper bounds (targets sharing their bounds share a trace)
+# window_offset: as in solve_frontier_windows
+def trace_frontier_windows(mu, cov, membership, target_volatility, lower, upper, log = None, window_offset = 0):
+    target_volatility = np.asarray(target_volatility, dtype = np.float64)
+    check_min_volatility(cov, target_volatility)
+    bounds, bound_id = np.unique(np.asarray(upper, dtype = np.float64), axis = 0, return_inverse = True)
+    bound_id = np.ravel(bound_id)
+
+    weights = np.empty((len(mu), len(target_volatility), np.shape(mu)[1]))
+    for a in range(len(mu)):
+        for j, bound in enumerate(bounds):
+            targets = np.flatnonzero(bound_id == j)
+            start = time.perf_counter()
+            frontier = Frontier(mu[a], cov[a], membership[a], lower, bound)
+            weights[a, targets] = frontier.weights(target_volatility[targets])
+            if log is not None:
+                log.record(window = window_offset + a, n_targets = len(targets), solver = 'frontier', status = 'optimal',
+                           iterations = len(frontier.t), wall_time = time.perf_counter() - start)
+    return clean_weights(weights)
+
+
+
+###13
+# cvxpy solvers tried in turn until one solves the problem. OSQP is installed
+# as well, but it does not take the second-order cone of the volatility
+# constraint.
+DEFAULT_SOLVERS = ['ECOS', 'SCS']
+
+
+# solver names in priority order: DEFAULT_SOLVERS that are installed for
+# None (the cvxpy default when none is), [solver] for a name, or the list
+def solver_priority(solver = None):
+    if solver is None:
+        installed = cp.installed_solvers()
+        return [name for name in DEFAULT_SOLVERS if name in installed] or [None]
+    if isinstance(solver, str):
+        return [solver]
+    return list(solver)
+
+
+# Structured log of the optimisations, one record per solve attempt:
+#   window: window number, target: volatility target (None when the targets
+#   of a window are solved together), n_targets: number of portfolios solved,
+#   solver, status, iterations, solve_time: time reported by the solver,
+#   wall_time: time including cvxpy's own work
+# path: JSON lines file each record is also appended to
+class SolveLog:
+
+    FIELDS = ['window', 'target', 'n_targets', 'solver', 'status', 'iterations', 'solve_time', 'wall_time']
+
+    def __init__(self, path = None):
+        self.path = path
+        self.records = []
+
+    def record(self, **fields):
+        record = {k: _json_value(fields.get(k)) for k in self.FIELDS}
+        self.extend([record])
+
+    def extend(self, records):
+        self.records.extend(records)
+        if self.path is not None and records:
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+
+    def to_frame(self):
+        return pd.DataFrame(self.records, columns = self.FIELDS)
+
+    # attempts, failures and times of the successful solves by solver and
+    # problem size, fastest per portfolio first
+    def summary(self):
+        df = self.to_frame()
+        df['failed'] = ~(df['status'].isin(['optimal', 'optimal_inaccurate']) | df['status'].str.startswith('polished'))
+        ok = df[~df['failed']]
+        by = ['solver', 'n_targets']
+        summary = df.groupby(by).agg(attempts = ('status', 'size'), failed = ('failed', 'sum')).join(
+            ok.groupby(by).agg(
+                mean_wall_time = ('wall_time', 'mean'),
+                median_wall_time = ('wall_time', 'median'),
+                mean_solve_time = ('solve_time', 'mean'),
+                mean_iterations = ('iterations', 'mean')
+                ))
+        summary['wall_time_per_portfolio'] = summary['mean_wall_time'] / summary.index.get_level_values('n_targets')
+        return summary.sort_values('wall_time_per_portfolio')
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+###14
+# Portfolio weights of every rebalance date in one contiguous
+# (n_dates x n_ports x n_assets) array, labelled with the dates, portfolio
+# names and assets.
+#   dates: date each row of weights is held for
+#   freq: rebalance frequency of the dates
+#   float32: stores the weights in single precision (half the memory)
+# lag(periods) is the same array with every row held 'periods' rebalance
+# periods later, the dates after the last one continuing with
+# next_period_end. Only the dates are new, the weights are not copied.
+class WeightsCube:
+
+    def __init__(self, values, dates, ports, assets, freq = 'M', float32 = False):
+        self.values = np.ascontiguousarray(values, dtype = np.float32 if float32 else np.float64)
+        self.dates = pd.DatetimeIndex(dates)
+        self.ports = pd.Index(ports)
+        self.assets = pd.Index(assets)
+        self.freq = freq
+        if self.values.shape != (len(self.dates), len(self.ports), len(self.assets)):
+            raise ValueError('weights of shape {} do not match {} dates x {} ports x {} assets'.format(
+                self.values.shape, len(self.dates), len(self.ports), len(self.assets)))
+
+    def lag(self, periods = 1):
+        extra = [self.dates[-1]]
+        for _ in range(periods):
+            extra.append(next_period_end(extra[-1], self.freq))
+        dates = self.dates.append(pd.DatetimeIndex(extra[1:]))[periods:]
+        return WeightsCube(self.values, dates, self.ports, self.assets, self.freq, self.values.dtype == np.float32)
+
+    # dates x assets frame of one portfolio, a view on the cube
+    def frame(self, port):
+        return pd.DataFrame(self.values[:, self.ports.get_loc(port), :], index = self.dates, columns = self.assets)
+
+    def to_dict(self):
+        return {port: self.frame(port) for port in self.ports}
+
+
+###15
+# first row of every 'W', 'M' or 'Q' period of the dates, the rows traded
+# back to the target weights by a calendar rebalance
+def rebalance_mask(dates, freq):
+    period = pd.DatetimeIndex(dates).to_period(PERIOD_DICT[freq][0])
+    mask = np.ones(len(period), dtype = bool)
+    mask[1:] = period[1:] != period[:-1]
+    return mask
+
+
+# Returns of every portfolio, the weights drifting with the asset returns
+# between rebalances. Whatever the weights do not invest is cash with no
+# return.
+#   weights: target weights, (n_dates x n_ports x n_assets)
+#   returns: asset returns over each date, (n_dates x n_assets)
+#   rebalance: boolean mask of the dates traded back to target (the first
+#              date always is), None for every date (no drift)
+#   threshold: trades a portfolio back to target on the dates one of its
+#              weights drifted more than 'threshold' away from it, on top of
+#              the rebalance dates (None then means none)
+# Returns the (n_dates x n_ports) returns and the mask of the dates each
+# portfolio was rebalanced.
+def portfolio_returns(weights, returns, rebalance = None, threshold = None):
+    returns = np.asarray(returns, dtype = np.float64)
+    n_dates, n_ports, n_assets = weights.shape
+    if threshold is not None:
+        return _threshold_returns(weights, returns, rebalance, threshold)
+    if rebalance is None:
+        return np.einsum('dpn,dn->dp', weights, returns), np.ones((n_dates, n_ports), dtype = bool)
+
+    rebalance = np.array(rebalance, dtype = bool)
+    rebalance[0] = True
+    start = np.maximum.accumulate(np.where(rebalance, np.arange(n_dates), 0))
+
+    # growth of every asset since its last rebalance, at the start of each
+    # date and over it
+    log_growth = np.cumsum(np.log1p(returns), axis = 0)
+    log_before = np.vstack([np.zeros((1, n_assets)), log_growth[:-1]])
+    growth = np.empty((2, n_dates, n_assets))
+    growth[0] = np.exp(log_before - log_before[start])
+    growth[1] = np.exp(log_growth - log_before[start]) - growth[0]
+
+    held = weights[start]
+    value_before, gain = np.einsum('dpn,kdn->kdp', held, growth)
+    value_before += 1 - held.sum(axis = 2)
+    return gain / value_before, np.repeat(rebalance[:, None], n_ports, axis = 1)
+
+
+def _threshold_returns(weights, returns, rebalance, threshold):
+    n_dates, n_ports, n_assets = weights.shape
+    port_returns = np.empty((n_dates, n_ports))
+    rebalanced = np.zeros((n_dates, n_ports), dtype = bool)
+    held = np.array(weights[0], dtype = np.float64)
+    for d in range(n_dates):
+        trade = np.abs(held - weights[d]).max(axis = 1) > threshold
+        if d == 0 or (rebalance is not None and rebalance[d]):
+            trade[:] = True
+        held[trade] = weights[d][trade]
+        rebalanced[d] = trade
+        port_returns[d] = held @ returns[d]
+        held *= (1 + returns[d]) / (1 + port_returns[d])[:, None]
+    return port_returns, rebalanced
+
+
+###16
+# Daily returns of the portfolios of a WeightsCube, streamed chunk by chunk.
+# Each period's weights are bought on its first day and drift with the daily
+# returns until the first day of the next period. Only the drifted holdings
+# are carried from one chunk to the next, so memory is bounded by the chunk
+# size however long the history is.
+#   cube: WeightsCube, each row held in the period of its date
+#   chunks: daily return frames in date order, with the cube's assets among
+#           the columns
+# Yields a days x ports frame per chunk, leaving out the days of periods the
+# cube has no weights for.
+def stream_daily_returns(cube, chunks):
+    period_freq = PERIOD_DICT[cube.freq][0]
+    cube_period = cube.dates.to_period(period_freq)
+    held = None
+    last_row = -1
+
+    for tr in chunks:
+        row = cube_period.get_indexer(tr.index.to_period(period_freq))
+        in_cube = row >= 0
+        tr = tr[in_cube]
+        row = row[in_cube]
+        if len(row) == 0:
+            continue
+
+        returns = tr[cube.assets].values
+        weights = cube.values[row]
+        rebalance = np.ones(len(row), dtype = bool)
+        rebalance[1:] = row[1:] != row[:-1]
+        # the period goes on from the last chunk
+        if row[0] == last_row:
+            weights[0] = held
+
+        port_rt, _ = portfolio_returns(weights, returns, rebalance)
+        start = np.flatnonzero(rebalance)[-1]
+        held = _drift(weights[start], returns[start:])
+        last_row = row[-1]
+
+        yield pd.DataFrame(port_rt, index = tr.index, columns = cube.ports)
+
+
+# weights (ports x assets) after buying and holding them over the returns,
+# as fractions of each portfolio's value
+def _drift(weights, returns):
+    held = weights * np.exp(np.log1p(returns).sum(axis = 0))
+    value = held.sum(axis = 1) + 1 - weights.sum(axis = 1)
+    return held / value[:, None]
@@ -2,177 +2,59 @@ import yfinance as yf
 
 import pandas as pd
 import numpy as np
-import pandas_datareader.data as reader
 import datetime as dt
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pandas.tseries.offsets import MonthEnd
 import statsmodels.api as sm
 
 import pypfopt
 from pypfopt import EfficientFrontier
-from pypfopt import risk_models
 from pypfopt import expected_returns
 from pypfopt import plotting 
 from pypfopt import objective_functions
 from pypfopt import black_litterman
 from pypfopt import HRPOpt
 
-import scipy.cluster.hierarchy as sch
-from scipy.cluster.hierarchy import dendrogram, linkage, cut_tree
+from scipy.cluster.hierarchy import dendrogram
 from scipy import optimize
 from scipy.stats import dirichlet
 import cvxpy
 
-
-### 1
-def load_asset_data(account):
-    file_name_etf = 'etf_daily_return.csv'
-    df_tr = pd.read_csv(file_name_etf, index_col='Dates')
-    df_tr.index = pd.to_datetime(df_tr.index)
-    
-    #just for style scheme
-    etf_list = list(df_tr.columns)
-    
-    if account == 'taxable':
-        exclude_etf= ['Emerging Market Bonds - USD']
-        etf_list_style = list(filter(lambda x: x not in exclude_etf, etf_list))
-    else:
-        etf_list_style = etf_list.copy()
-
-    #
-    style_df = df_tr[etf_list_style].copy()
-    start_dt = str(style_df.index[-1:][0]).split(' ')[0]
-
-    if account == 'taxable':
-        tk_list = [
-            'IEMG', 
-            'VEA', 
-            'IVW',
-            'IWO',
-            'IVE',
-            'MTUM',
-            'VOO',
-            'IWM',
-            'IEF',
-            'SHV', 
-            'VTEB',
-            'TIP',
-            'HYG',
-            'LQD',
-            # 'EMB',
-            'BNDX',
-            'IAU'
-        ]
-    else: 
-         tk_list = [
-            'IEMG', 
-            'VEA', 
-            'IVW',
-            'IWO',
-            'IVE',
-            'MTUM',
-            'VOO',
-            'IWM',
-            'IEF',
-            'SHV', 
-            'VTEB',
-            'TIP',
-            'HYG',
-            'LQD',
-            'EMB',
-            'BNDX',
-            'IAU'
-        ]
-        
-    
-    # updates df with latest prices
-    yf_df = yf.download(tk_list, start = start_dt)['Adj Close']
-    yf_df = yf_df.pct_change()
-
-    if account == "taxable":
-        yf_df = yf_df.rename(columns={
-            "IEMG": "Emerging Market Stocks",
-            "VEA": "Foreign Developed Stocks",
-            "IVW": "US Stocks - Growth (Large Cap)",
-            "IWO": "US Stocks - Growth (Small Cap)",
-            "IVE": "US Stocks - Value (Large Cap)", 
-            "MTUM": "US Stocks - Momentum",
-            "VOO": "US Stocks - Size (Large Cap)", 
-            "IWM": "US Stocks - Size (Small Cap)",
-            "IEF": "US Government Bonds - Long Term",
-            "SHV": "US Government Bonds - Short Term",
-            "VTEB": "Municipal Bonds",
-            "TIP": "TIPS",
-            "HYG": "US Corporate Bonds - High Yield", 
-            "LQD": "US Corporate Bonds - Investment Grade",
-            # "EMB": "Emerging Market Bonds - USD", 
-            "BNDX": "Global Aggregate Bonds ex-US",
-            "IAU": "Gold"
-            })
-    else:
-        yf_df = yf_df.rename(columns={
-            "IEMG": "Emerging Market Stocks",
-            "VEA": "Foreign Developed Stocks",
-            "IVW": "US Stocks - Growth (Large Cap)",
-            "IWO": "US Stocks - Growth (Small Cap)",
-            "IVE": "US Stocks - Value (Large Cap)", 
-            "MTUM": "US Stocks - Momentum",
-            "VOO": "US Stocks - Size (Large Cap)", 
-            "IWM": "US Stocks - Size (Small Cap)",
-            "IEF": "US Government Bonds - Long Term",
-            "SHV": "US Government Bonds - Short Term",
-            "VTEB": "Municipal Bonds",
-            "TIP": "TIPS",
-            "HYG": "US Corporate Bonds - High Yield", 
-            "LQD": "US Corporate Bonds - Investment Grade",
-            "EMB": "Emerging Market Bonds - USD", 
-            "BNDX": "Global Aggregate Bonds ex-US",
-            "IAU": "Gold"
-            })
-    
-    style_df = pd.concat([style_df, yf_df[2:]],axis=0)
-    style_tr = style_df.copy()
-    style_tr = style_tr.dropna()
-    style_price = style_tr.copy()
-    style_price = (1 + style_price).cumprod() 
-    
-    asset_m = style_price.resample('M').last()
-    first_row = asset_m.iloc[0,:]
-    first_row = first_row - 1
-    asset_m = asset_m.pct_change()
-    asset_m.iloc[0,:] = first_row
-    
-    return asset_m
-
-
-###2
-def load_factor_data():
-    # Load factor data
-     
-    start = dt.date(1990,7,1)
-    
-    # monthly
-    us_factors = reader.DataReader('F-F_Research_Data_5_Factors_2x3','famafrench',start)[0]
-    month_end_list = pd.date_range(start = start, end = None, periods = us_factors.shape[0], freq = 'M')
-    us_factors.index = list(month_end_list)
-    us_factors = us_factors / 100
-    
-    dm_factors = reader.DataReader('Developed_ex_US_5_Factors','famafrench',start)[0]
-    month_end_list = pd.date_range(start = start, end = None, periods = dm_factors.shape[0], freq = 'M')
-    dm_factors.index = list(month_end_list)
-    dm_factors = dm_factors / 100
-    
-    em_factors = reader.DataReader('Emerging_5_Factors','famafrench',start)[0]
-    month_end_list = pd.date_range(start = start, end = None, periods = em_factors.shape[0], freq = 'M')
-    em_factors.index = list(month_end_list)
-    em_factors = em_factors / 100
-
-    return us_factors, dm_factors, em_factors
-
-
-###3
-def make_asset_rf(account):
-    if account == 'taxable':
-        us_list = [ # 13 assets
+import monero_data_ff
+import monero_engine_ff
+
+
+###0
+TICKER_NAME_DICT = {
+    "IEMG": "Emerging Market Stocks",
+    "VEA": "Foreign Developed Stocks",
+    "IVW": "US Stocks - Growth (Large Cap)",
+    "IWO": "US Stocks - Growth (Small Cap)",
+    "IVE": "US Stocks - Value (Large Cap)", 
+    "MTUM": "US Stocks - Momentum",
+    "VOO": "US Stocks - Size (Large Cap)", 
+    "IWM": "US Stocks - Size (Small Cap)",
+    "IEF": "US Government Bonds - Long Term",
+    "SHV": "US Government Bonds - Short Term",
+    "VTEB": "Municipal Bonds",
+    "TIP": "TIPS",
+    "HYG": "US Corporate Bonds - High Yield", 
+    "LQD": "US Corporate Bonds - Investment Grade",
+    "EMB": "Emerging Market Bonds - USD", 
+    "BNDX": "Global Aggregate Bonds ex-US",
+    "IAU": "Gold"
+    }
+
+EXCLUDE_ETF_DICT = {
+    'taxable': ['Emerging Market Bonds - USD'],
+    'retirement': []
+    }
+
+# assets regressed on the us, developed ex-us and emerging factor sets
+REGION_ASSET_DICT = {
+    'us': [ # 13 assets
         "US Stocks - Growth (Large Cap)", 
         "US Stocks - Growth (Small Cap)",
         "US Stocks - Value (Large Cap)", 
@@ -186,202 +68,321 @@ def make_asset_rf(account):
         "US Corporate Bonds - High Yield", 
         "US Corporate Bonds - Investment Grade",
         "Gold"
-        ]
-        
-        dm_list = [ # 2 assets
-        "Foreign Developed Stocks", 
-        "Global Aggregate Bonds ex-US"
-        ]
-        
-        em_list = [ # 1 assets
-        "Emerging Market Stocks"
-        # "Emerging Market Bonds - USD"
-        ]
-    else:
-        us_list = [ # 13 assets
-        "US Stocks - Growth (Large Cap)", 
-        "US Stocks - Growth (Small Cap)",
-        "US Stocks - Value (Large Cap)", 
-        "US Stocks - Momentum",
-        "US Stocks - Size (Large Cap)", 
-        "US Stocks - Size (Small Cap)",
-        "US Government Bonds - Long Term",
-        "US Government Bonds - Short Term",
-        "Municipal Bonds", 
-        "TIPS",
-        "US Corporate Bonds - High Yield", 
-        "US Corporate Bonds - Investment Grade",
-        "Gold"
-        ]
-        
-        dm_list = [ # 2 assets
+        ],
+    'dm': [ # 2 assets
         "Foreign Developed Stocks", 
         "Global Aggregate Bonds ex-US"
-        ]
-        
-        em_list = [ # 2 assets
+        ],
+    'em': [ # 2 assets
         "Emerging Market Stocks",
         "Emerging Market Bonds - USD"
         ]
+    }
+
+FACTOR_DATASETS = {
+    'us': 'F-F_Research_Data_5_Factors_2x3',
+    'dm': 'Developed_ex_US_5_Factors',
+    'em': 'Emerging_5_Factors'
+    }
+
+
+# The yfinance / Fama-French market data, see monero_data_ff.MarketDataProvider
+# factor_cache: optional monero_data_ff.FactorCache for the factor downloads
+# price_store: optional monero_data_ff.PriceStore replacing the csv + full
+#              yfinance gap download with a delta refresh of the store
+# fetcher: monero_data_ff.RemoteFetcher running the downloads concurrently
+# The prices are downloaded once per provider (so once per DataContext): the
+# store is refreshed on first use and then only read, the csv + download
+# merge is kept in memory.
+class RemoteProvider(monero_data_ff.MarketDataProvider):
+
+    def __init__(self, file_name_etf = 'etf_daily_return.csv', factor_cache = None, price_store = None, fetcher = None):
+        self.file_name_etf = file_name_etf
+        self.factor_cache = factor_cache
+        self.price_store = price_store
+        self.fetcher = monero_data_ff.RemoteFetcher() if fetcher is None else fetcher
+        self._daily_tr = None
+        self._refreshed = False
+
+    def daily_returns(self):
+        if self.price_store is None:
+            if self._daily_tr is None:
+                self._daily_tr = load_daily_return_data(self.file_name_etf, self.fetcher)
+            return self._daily_tr
+        self._refresh_store()
+        return self.price_store.read()
+
+    # without a PriceStore the csv and the downloads are merged in memory
+    def daily_return_chunks(self, columns = None, chunk_size = 260):
+        if self.price_store is None:
+            return super().daily_return_chunks(columns, chunk_size)
+        self._refresh_store()
+        return self.price_store.read_chunks(columns = columns)
+
+    def _refresh_store(self):
+        if not self._refreshed:
+            update_price_store(self.price_store, self.file_name_etf, self.fetcher)
+            self._refreshed = True
+
+    def factor_returns(self):
+        return dict(zip(FACTOR_DATASETS.keys(), load_factor_data(self.factor_cache, self.fetcher)))
+
+    def region_assets(self):
+        return REGION_ASSET_DICT
+
+
+# Everything one pipeline run reads from disk or the network.
+# Each dataset is loaded on first use and then shared by all the functions
+# below and by both accounts, so pass the same context through a whole run.
+# provider: monero_data_ff.MarketDataProvider, defaults to a RemoteProvider
+#           built from the other arguments
+# freq: rebalance period, 'W', 'M' or 'Q' (see monero_engine_ff.PERIOD_DICT)
+class DataContext:
+
+    def __init__(self, file_name_etf = 'etf_daily_return.csv', factor_cache = None, price_store = None, fetcher = None, provider = None, freq = 'M'):
+        if provider is None:
+            provider = RemoteProvider(file_name_etf, factor_cache, price_store, fetcher)
+        self.provider = provider
+        self.freq = freq
+        self._daily_tr = None
+        self._factors = None
+        self._asset_m = {}
+        self._excess = {}
+
+    def daily_tr(self):
+        if self._daily_tr is None:
+            self._daily_tr = self.provider.daily_returns()
+        return self._daily_tr
+
+    # daily returns a chunk at a time, slices of daily_tr() once it is loaded
+    def daily_chunks(self, columns = None, chunk_size = 260):
+        if self._daily_tr is None:
+            return self.provider.daily_return_chunks(columns, chunk_size)
+        daily_tr = self._daily_tr if columns is None else self._daily_tr.reindex(columns = columns)
+        return (daily_tr.iloc[start:start + chunk_size] for start in range(0, len(daily_tr), chunk_size))
+
+    def asset_m(self, account):
+        if account not in self._asset_m:
+            self._asset_m[account] = make_asset_m(self.daily_tr(), account, self.freq)
+        return self._asset_m[account]
+
+    # factor frames in region order, at the rebalance frequency
+    def factors(self):
+        if self._factors is None:
+            factor_dict = self.provider.factor_returns()
+            region_list = list(self.provider.region_assets())
+            if set(factor_dict) != set(region_list):
+                raise ValueError('factor regions {} do not match asset regions {}'.format(sorted(factor_dict), sorted(region_list)))
+            self._factors = tuple(monero_engine_ff.aggregate_factors(factor_dict[region], self.freq) for region in region_list)
+        return self._factors
+
+    def periods_per_year(self):
+        return monero_engine_ff.periods_per_year(self.freq)
+
+    # the account's assets of each region, in region order (the key order
+    # of region_assets(), which factors() follows too)
+    def region_lists(self, account):
+        etf_list = list(self.asset_m(account).columns)
+        return [[i for i in asset_list if i in etf_list] for asset_list in self.provider.region_assets().values()]
+
+    # loads prices and factors at the same time
+    def prefetch(self):
+        with ThreadPoolExecutor(max_workers = 2) as pool:
+            futures = [pool.submit(self.daily_tr), pool.submit(self.factors)]
+            for f in futures:
+                f.result()
+
+    # excess return frame of all the account's assets (region blocks in
+    # region order) and the factor frames on the same dates
+    def excess_returns(self, account):
+        if account not in self._excess:
+            self._excess[account] = monero_engine_ff.align_excess_returns(
+                self.asset_m(account), self.region_lists(account), self.factors())
+        return self._excess[account]
+
+    # excess returns split by region
+    def asset_rf(self, account):
+        asset_rf, factor_list = self.excess_returns(account)
+        return tuple(asset_rf[asset_list] for asset_list in self.region_lists(account))
 
-    #dataset
-    asset_m = load_asset_data(account)
-    us_factors, dm_factors, em_factors = load_factor_data()
 
-    intersection_date = list(set(list(us_factors.index))&set(list(dm_factors.index)))
-    intersection_date = list(set(intersection_date)&set(list(em_factors.index)))
-    intersection_date = list(set(intersection_date)&set(list(asset_m.index)))
-    intersection_date.sort()
+### 1
+# Ticker.history keeps its state on the Ticker, unlike yf.download, whose
+# module-level results get reset by every other concurrent call
+def _download_adj_close_one(tk, start_dt):
+    price = yf.Ticker(tk).history(start = start_dt, auto_adjust = False)
+    if price.empty:
+        raise IOError('no prices downloaded for {}'.format(tk))
+    return price['Adj Close'].rename(tk)
 
-    # Dependent Variable
-       
-    # 1) us
-    us_asset = asset_m[us_list]
-    # 2) dm ex us
-    dm_asset = asset_m[dm_list]
-    # 3) em
-    em_asset = asset_m[em_list]
-
-    us_asset_rf = us_asset[us_asset.index.isin(intersection_date)]
-    us_rf_series = us_factors['RF'][intersection_date]
-    for i in us_list:
-        us_asset_rf[i] = us_asset_rf[i] - us_rf_series
-        
-    dm_asset_rf = dm_asset[dm_asset.index.isin(intersection_date)]
-    dm_rf_series = dm_factors['RF'][intersection_date]
-    for i in dm_list:
-        dm_asset_rf[i] = dm_asset_rf[i] - dm_rf_series
-        
-    em_asset_rf = em_asset[em_asset.index.isin(intersection_date)]
-    em_rf_series = em_factors['RF'][intersection_date]    
-    for i in em_list:
-        em_asset_rf[i] = em_asset_rf[i] - em_rf_series
 
-    return us_asset_rf, dm_asset_rf, em_asset_rf
+# adjusted close of every ticker, one concurrent request per ticker
+def download_adj_close(tk_list, start_dt, fetcher = None):
+    if fetcher is None:
+        fetcher = monero_data_ff.RemoteFetcher()
+    price_list = fetcher.map(lambda tk: _download_adj_close_one(tk, start_dt), tk_list)
+    return pd.concat(price_list, axis = 1)
 
 
-###4
-def make_expected_return_dict(account, window):
+# daily returns of every etf, csv history + latest yfinance prices
+def load_daily_return_data(file_name_etf = 'etf_daily_return.csv', fetcher = None):
+    df_tr = monero_data_ff.read_etf_daily_return(file_name_etf)
+    start_dt = str(df_tr.index[-1:][0]).split(' ')[0]
 
-    us_asset_rf, dm_asset_rf, em_asset_rf = make_asset_rf(account)
-    us_factors, dm_factors, em_factors = load_factor_data()
-    intersection_date = list(us_asset_rf.index)
+    tk_list = [tk for tk, name in TICKER_NAME_DICT.items() if name in df_tr.columns]
 
-    # make dictionary of factor and asset return
-    us_factors_chopped = us_factors[us_factors.index.isin(intersection_date)]
-    dm_factors_chopped = dm_factors[dm_factors.index.isin(intersection_date)]
-    em_factors_chopped = em_factors[em_factors.index.isin(intersection_date)]
-    
-    us_factors_dict = {}
-    us_asset_rf_dict = {}
-    
-    dm_factors_dict = {}
-    dm_asset_rf_dict = {}
-    
-    em_factors_dict = {}
-    em_asset_rf_dict = {}
-    
-    b = len(intersection_date)
+    # updates df with latest prices
+    yf_df = download_adj_close(tk_list, start_dt, fetcher)
+    yf_df = make_new_daily_return(yf_df, df_tr.index[-1])
+
+    return pd.concat([df_tr, yf_df], axis=0)
+
+
+# seeds an empty store from the csv, then appends the yfinance returns after
+# the last ingested date
+def update_price_store(price_store, file_name_etf = 'etf_daily_return.csv', fetcher = None):
+    if price_store.is_empty():
+        df_tr = monero_data_ff.read_etf_daily_return(file_name_etf)
+        price_store.append(df_tr)
+
+    last_dates = price_store.last_dates()
+    start_dt = str(min(last_dates.values()).date())
+    tk_list = [tk for tk, name in TICKER_NAME_DICT.items() if name in last_dates]
+
+    yf_df = download_adj_close(tk_list, start_dt, fetcher)
+    yf_df = make_new_daily_return(yf_df, min(last_dates.values()))
+
+    return price_store.append(yf_df)
+
+
+# Returns of the downloaded prices of the days after last_date, the same
+# trim for the csv and the PriceStore. Today's session is left out: its bar
+# keeps changing until the close, and the store never rewrites a date once
+# it is ingested (it is picked up by the first run of the next day).
+def make_new_daily_return(price, last_date, today = None):
+    if today is None:
+        today = pd.Timestamp.today().normalize()
+    yf_df = price.pct_change()
+    yf_df = yf_df[(yf_df.index > last_date) & (yf_df.index < today)]
+    return yf_df.rename(columns = TICKER_NAME_DICT)
+
+
+# returns of the account's etfs per rebalance period ('W', 'M' or 'Q')
+def make_asset_m(daily_tr, account, freq = 'M'):
+    #just for style scheme
+    etf_list = list(daily_tr.columns)
+    exclude_etf = EXCLUDE_ETF_DICT.get(account, [])
+    etf_list_style = list(filter(lambda x: x not in exclude_etf, etf_list))
+
+    style_tr = daily_tr[etf_list_style].dropna()
+    asset_m = monero_engine_ff.aggregate_returns(style_tr, freq)
     
-    for a in range(b-window):      
-        us_factors_dict[a] = us_factors_chopped[a:a+window]
-        us_asset_rf_dict[a] = us_asset_rf[a:a+window]
-        #
-        dm_factors_dict[a] = dm_factors_chopped[a:a+window]
-        dm_asset_rf_dict[a] = dm_asset_rf[a:a+window]
-        #
-        em_factors_dict[a] = em_factors_chopped[a:a+window]
-        em_asset_rf_dict[a] = em_asset_rf[a:a+window]
+    return asset_m
+
+
+def load_asset_data(account, ctx = None):
+    if ctx is None:
+        ctx = DataContext()
+    return ctx.asset_m(account)
+
+
+###2
+def fetch_factor_data(name, start = dt.date(1990,7,1)):
+    # monthly
+    factors = monero_data_ff.read_famafrench(name, start)
+    month_end_list = pd.date_range(start = start, end = None, periods = factors.shape[0], freq = 'M')
+    factors.index = list(month_end_list)
+    factors = factors / 100
+
+    return factors
+
+
+def load_factor_data(factor_cache = None, fetcher = None):
+    if fetcher is None:
+        fetcher = monero_data_ff.RemoteFetcher()
+
+    # only the download is retried, not the cache lookup
+    def load_one(name):
+        fetch = lambda x: fetcher.call(fetch_factor_data, x)
+        if factor_cache is None:
+            return fetch(name)
+        return factor_cache.get(name, fetch)
+
+    # Load factor data, the three sets at once
+    factor_list = fetcher.map(load_one, FACTOR_DATASETS.values(), retry = False)
+
+    us_factors, dm_factors, em_factors = factor_list
+
+    return us_factors, dm_factors, em_factors
+
+
+###3
+def make_asset_rf(account, ctx = None):
+    if ctx is None:
+        ctx = DataContext()
+    return ctx.asset_rf(account)
+
+
+# all the account's excess returns in one frame
+def make_excess_return_df(account, ctx = None):
+    if ctx is None:
+        ctx = DataContext()
+    return ctx.excess_returns(account)[0]
+
+
+###4
+# engine: 'batched' solves every window of a region at once
+#         (monero_engine_ff.rolling_factor_regression), 'incremental' slides
+#         rank-one updated cross products over the rows
+#         (monero_engine_ff.incremental_factor_regression), 'statsmodels' fits
+#         one sm.OLS per asset and window
+def make_expected_return_dict(account, window, ctx = None, engine = 'batched'):
+    if ctx is None:
+        ctx = DataContext()
+
+    asset_rf, factor_list = ctx.excess_returns(account)
+    region_lists = ctx.region_lists(account)
+    b = len(asset_rf.index)
+
+    if engine in ['batched', 'incremental']:
+        factor_arrays = [factors[monero_engine_ff.FACTOR_NAMES].values for factors in factor_list]
+        col_region = monero_engine_ff.make_col_region(region_lists)
+
+        if engine == 'batched':
+            regression = monero_engine_ff.rolling_factor_regression(
+                asset_rf.values, factor_arrays, col_region, window, b - window, fitted = True)
+            fitted = regression.fitted
+        else:
+            regression, _ = monero_engine_ff.incremental_factor_regression(
+                asset_rf.values, factor_arrays, col_region, window, b - window)
+            fitted = monero_engine_ff.fitted_values(regression, factor_arrays, col_region, window)
+
+        expected_return_rf_dict = {}
+        for a in range(b-window):
+            expected_return_rf_dict[a] = pd.DataFrame(fitted[a], index = asset_rf.index[a:a+window], columns = asset_rf.columns)
+        return expected_return_rf_dict
+
+    if engine != 'statsmodels':
+        raise ValueError('unknown regression engine {!r}'.format(engine))
 
     # do OLS
     expected_return_rf_dict = {}
 
-    if account == 'taxable':
-        us_list = [ # 13 assets
-        "US Stocks - Growth (Large Cap)", 
-        "US Stocks - Growth (Small Cap)",
-        "US Stocks - Value (Large Cap)", 
-        "US Stocks - Momentum",
-        "US Stocks - Size (Large Cap)", 
-        "US Stocks - Size (Small Cap)",
-        "US Government Bonds - Long Term",
-        "US Government Bonds - Short Term",
-        "Municipal Bonds", 
-        "TIPS",
-        "US Corporate Bonds - High Yield", 
-        "US Corporate Bonds - Investment Grade",
-        "Gold"
-        ]
-        
-        dm_list = [ # 2 assets
-        "Foreign Developed Stocks", 
-        "Global Aggregate Bonds ex-US"
-        ]
-        
-        em_list = [ # 1 assets
-        "Emerging Market Stocks"
-        # "Emerging Market Bonds - USD"
-        ]
-    else:
-        us_list = [ # 13 assets
-        "US Stocks - Growth (Large Cap)", 
-        "US Stocks - Growth (Small Cap)",
-        "US Stocks - Value (Large Cap)", 
-        "US Stocks - Momentum",
-        "US Stocks - Size (Large Cap)", 
-        "US Stocks - Size (Small Cap)",
-        "US Government Bonds - Long Term",
-        "US Government Bonds - Short Term",
-        "Municipal Bonds", 
-        "TIPS",
-        "US Corporate Bonds - High Yield", 
-        "US Corporate Bonds - Investment Grade",
-        "Gold"
-        ]
-        
-        dm_list = [ # 2 assets
-        "Foreign Developed Stocks", 
-        "Global Aggregate Bonds ex-US"
-        ]
-        
-        em_list = [ # 2 assets
-        "Emerging Market Stocks",
-        "Emerging Market Bonds - USD"
-        ]
-
     for a in range(b-window):
 
         expected_returns = pd.DataFrame()    
     
-        # us
-        for i in us_list:
-            y = us_asset_rf_dict[a][i] # Dependent variable
-            x = us_factors_dict[a][['Mkt-RF', 'SMB','HML','RMW', 'CMA']]
-            X_sm = sm.add_constant(x)
-            model = sm.OLS(y, X_sm)
-            results = model.fit()
-            temp_expected = pd.DataFrame(results.predict(exog = X_sm), columns = [i])
-            expected_returns = pd.concat([expected_returns,temp_expected], axis = 1)
-
-        # dm
-        for j in dm_list:
-            y = dm_asset_rf_dict[a][j] # Dependent variable
-            x = dm_factors_dict[a][['Mkt-RF', 'SMB','HML','RMW', 'CMA']]
-            X_sm = sm.add_constant(x)
-            model = sm.OLS(y, X_sm)
-            results = model.fit()
-            temp_expected = pd.DataFrame(results.predict(exog = X_sm), columns = [j])
-            expected_returns = pd.concat([expected_returns,temp_expected], axis = 1)
-
-        # em
-        for k in em_list:
-            y = em_asset_rf_dict[a][k] # Dependent variable
-            x = em_factors_dict[a][['Mkt-RF', 'SMB','HML','RMW', 'CMA']]
+        # one factor set per region
+        for asset_list, factors in zip(region_lists, factor_list):
+            x = factors[a:a+window][['Mkt-RF', 'SMB','HML','RMW', 'CMA']]
             X_sm = sm.add_constant(x)
-            model = sm.OLS(y, X_sm)
-            results = model.fit()
-            temp_expected = pd.DataFrame(results.predict(exog = X_sm), columns = [k])
-            expected_returns = pd.concat([expected_returns,temp_expected], axis = 1)
+
+            for i in asset_list:
+                y = asset_rf[i][a:a+window] # Dependent variable
+                model = sm.OLS(y, X_sm)
+                results = model.fit()
+                temp_expected = pd.DataFrame(results.predict(exog = X_sm), columns = [i])
+                expected_returns = pd.concat([expected_returns,temp_expected], axis = 1)
 
         expected_return_rf_dict[a] = expected_returns
     
@@ -390,14 +391,45 @@ def make_expected_return_dict(account, window):
 
 
 
+###4-2
+# Expected excess returns of every window as one array instead of a dict of
+# fitted-value frames, see monero_engine_ff.ExpectedReturns.
+# exposures = True also keeps the alphas and betas
+# engine: 'batched' or 'incremental', as in make_expected_return_dict
+# start: first window, the windows before it are left out
+def make_expected_return_array(account, window, ctx = None, engine = 'batched', exposures = False, start = 0):
+    if ctx is None:
+        ctx = DataContext()
+
+    asset_rf, factor_list = ctx.excess_returns(account)
+    b = len(asset_rf.index)
+    factor_arrays = [factors[monero_engine_ff.FACTOR_NAMES].values[start:] for factors in factor_list]
+    col_region = monero_engine_ff.make_col_region(ctx.region_lists(account))
+
+    if engine == 'batched':
+        regression = monero_engine_ff.rolling_factor_regression(
+            asset_rf.values[start:], factor_arrays, col_region, window, b - window - start)
+    elif engine == 'incremental':
+        regression, _ = monero_engine_ff.incremental_factor_regression(
+            asset_rf.values[start:], factor_arrays, col_region, window, b - window - start)
+    else:
+        raise ValueError('unknown regression engine {!r}'.format(engine))
+
+    return monero_engine_ff.ExpectedReturns(
+        mu = regression.fitted_mean,
+        alpha = regression.alpha if exposures else None,
+        beta = regression.beta if exposures else None,
+        dates = asset_rf.index[window - 1 + start:b - 1],
+        columns = list(asset_rf.columns)
+        )
+
+
 ###5
-def make_asset_rf_dict(account, window):
-    us_asset_rf, dm_asset_rf, em_asset_rf = make_asset_rf(account)
-    asset_rf = pd.concat([us_asset_rf, dm_asset_rf, em_asset_rf], axis = 1)
+def make_asset_rf_dict(account, window, ctx = None):
+    asset_rf = make_excess_return_df(account, ctx)
     asset_rf_dict = {}
 
-    intersection_date = list(us_asset_rf.index)
-    b = len(intersection_date)
+    b = len(asset_rf.index)
     
     for a in range(b-window):
         asset_rf_dict[a] = asset_rf[a:a+window]
@@ -407,63 +439,28 @@ def make_asset_rf_dict(account, window):
 
 
 ###6
-def make_asset_mapper_dict(account, window):
-    us_asset_rf, dm_asset_rf, em_asset_rf = make_asset_rf(account)
-    asset_rf = pd.concat([us_asset_rf, dm_asset_rf, em_asset_rf], axis = 1)
-    asset_rf_dict = {}
+# (n_windows x n_assets) int8 cluster numbers of the assets in each window,
+# numbered to stay the same from one window to the next
+# cluster_cache: monero_engine_ff.ClusterCache, to skip re-clustering the
+#                windows whose distance matrix did not move
+# start, prev_labels: first window and the labels of the one before it, see
+#                     monero_engine_ff.cluster_labels
+def make_cluster_label_array(account, window, ctx = None, cluster_cache = None, start = 0, prev_labels = None):
+    asset_rf = make_excess_return_df(account, ctx)
+    b = len(asset_rf.index)
+    return monero_engine_ff.cluster_labels(asset_rf.values, window, b - window, n_clusters = 8, cache = cluster_cache,
+                                           start = start, prev_labels = prev_labels)
 
-    intersection_date = list(us_asset_rf.index)
-    b = len(intersection_date)
-    
-    for a in range(b-window):
-        asset_rf_dict[a] = asset_rf[a:a+window]
 
-    link_dict = {}
-    for a in range(b - window):
-        temp = asset_rf_dict[a]
-        cov,corr = temp.cov(), temp.corr()
-        dist = ((1-corr)/2.) ** .5
-        link = sch.linkage(dist, 'single')        
-        link_dict[a] = link   
-        
-    cluster_info = pd.DataFrame(index = asset_rf.index[window:], columns = asset_rf.columns)   
-
-    num_of_cluster = 8
-    for a in range(b - window):
-        cluster_temp = cut_tree(link_dict[a], num_of_cluster)
-        cluster_temp = pd.DataFrame(cluster_temp)
-        cluster_temp = cluster_temp.T
-        cluster_temp.columns = cluster_info.columns
-        cluster_info[a:a+1] = cluster_temp
-    
+def make_asset_mapper_dict(account, window, ctx = None):
+    asset_rf = make_excess_return_df(account, ctx)
+    labels = make_cluster_label_array(account, window, ctx)
+    names = monero_engine_ff.cluster_names(labels)
+    col_list = list(asset_rf.columns)
+
     asset_mapper_dict = {}
-    date_list = list(cluster_info.index)
-    col_list = list(cluster_info.columns)
-    
-    for i,j in enumerate(date_list):
-        temp_map = {}
-        
-        for k in col_list:
-            a = cluster_info[k][j]
-        
-            if a == 0:
-                temp_map[k] = 'cluster_0'
-            elif a == 1:
-                temp_map[k] = 'cluster_1'
-            elif a == 2:
-                temp_map[k] = 'cluster_2'
-            elif a == 3:
-                temp_map[k] = 'cluster_3'
-            elif a == 4:
-                temp_map[k] = 'cluster_4'
-            elif a == 5:
-                temp_map[k] = 'cluster_5'
-            elif a == 6:
-                temp_map[k] = 'cluster_6'
-            else:
-                temp_map[k] = 'cluster_7'
-        
-        asset_mapper_dict[i] = temp_map
+    for a in range(len(labels)):
+        asset_mapper_dict[a] = dict(zip(col_list, names[a]))
 
     return asset_mapper_dict
 
@@ -589,30 +586,114 @@ def make_lower_bnd_dict():
         }
     return lower_bnd
 
+# bound dict -> array of the bounds in cluster number order
+def make_bnd_array(bnd_dict, num_of_cluster = 8):
+    return np.array([bnd_dict['cluster_{}'.format(c)] for c in range(num_of_cluster)])
+
 
 
 ###7
-def make_port_asset_wgt_dict(account, window):    
+# cluster_cache: monero_engine_ff.ClusterCache holding the clustering and
+#                constraint reuse counts of the run, see its stats()
+# engine: 'parametric' (one monero_engine_ff.FrontierSolver re-solved for
+#         the 10 targets of every window), 'admm' (all windows and targets
+#         at once with monero_engine_ff.admm_frontier_windows), 'frontier'
+#         (one traced monero_engine_ff.Frontier per window and bound set) or
+#         'efficient_frontier' (a new pypfopt EfficientFrontier for every solve)
+# solver: cvxpy solver name or names tried in turn until one succeeds,
+#         None for monero_engine_ff.DEFAULT_SOLVERS
+# workers: number of processes solving the windows of the parametric engine
+#          (1 solves them in this process, None uses all the cores)
+# chunk_size: number of windows sent to a worker at a time
+# solve_log: monero_engine_ff.SolveLog recording every solve
+# window_store: monero_data_ff.WindowStore of the weights of earlier runs,
+#               only the windows after them are computed (see
+#               load_window_results) and the store is updated
+def make_port_asset_wgt_dict(account, window, ctx = None, cluster_cache = None, engine = 'parametric', solver = None,
+                             workers = 1, chunk_size = None, solve_log = None, window_store = None):
+    if ctx is None:
+        ctx = DataContext()
 
     vol_list = []    
     for i in range(10):
         vol_list.append('{:.1f}%'.format(6+i)) # changed
 
+    asset_rf = make_excess_return_df(account, ctx)
+    b = len(asset_rf.index)
+    if b - window <= 0:
+        return {}
+
+    start, stored = 0, {}
+    if window_store is not None:
+        start, stored = load_window_results(account, window, engine, window_store, ctx, solver)
+
+    if start < b - window:
+        wgt_array, labels = make_port_asset_wgt_array(account, window, ctx, cluster_cache, engine, solver, workers, chunk_size,
+                                                      solve_log, start, stored['labels'][-1] if start > 0 else None)
+    else:
+        wgt_array, labels = stored['weights'][:0], stored['labels'][:0]
+
+    if window_store is not None:
+        if start > 0:
+            wgt_array = np.concatenate([stored['weights'], wgt_array])
+            labels = np.concatenate([stored['labels'], labels])
+        window_store.save(account, make_window_meta(account, window, engine, b - window, ctx, solver),
+                          {'weights': wgt_array, 'labels': labels})
+
+    return {a: pd.DataFrame(wgt_array[a], index = vol_list, columns = asset_rf.columns) for a in range(b - window)}
+
+
+# (windows x 10 x assets) weights and (windows x assets) cluster labels of
+# the windows from 'start' on, as in 'make_port_asset_wgt_dict'
+# prev_labels: labels of the window before 'start', for the cluster numbers
+def make_port_asset_wgt_array(account, window, ctx = None, cluster_cache = None, engine = 'parametric', solver = None,
+                              workers = 1, chunk_size = None, solve_log = None, start = 0, prev_labels = None):
+    if ctx is None:
+        ctx = DataContext()
+    if cluster_cache is None:
+        cluster_cache = monero_engine_ff.ClusterCache()
+
     #
-    expected_return_rf_dict = make_expected_return_dict(account, window)
+    expected_return = make_expected_return_array(account, window, ctx, start = start)
     #
-    asset_mapper_dict = make_asset_mapper_dict(account, window)
+    labels = make_cluster_label_array(account, window, ctx, cluster_cache, start, prev_labels)
     upper_bnd = make_upper_bnd_dict()
-    lower_bnd = make_lower_bnd_dict()
+    upper_bnd = [make_bnd_array(upper_bnd[i]) for i in range(10)]
+    lower_bnd = make_bnd_array(make_lower_bnd_dict())
 
     #
-    us_asset_rf, dm_asset_rf, em_asset_rf = make_asset_rf(account)
-    asset_rf = pd.concat([us_asset_rf, dm_asset_rf, em_asset_rf], axis = 1)
-    asset_rf_dict = {}
-    intersection_date = list(us_asset_rf.index)
-    b = len(intersection_date)    
-    for a in range(b-window):
-        asset_rf_dict[a] = asset_rf[a:a+window]
+    asset_rf = make_excess_return_df(account, ctx)
+    b = len(asset_rf.index)
+    freq = ctx.periods_per_year()
+    cov_array, _ = monero_engine_ff.ledoit_wolf_single_factor(asset_rf.values[start:], window, b - window - start, freq)
+    mu_array = ((1 + expected_return.mu) ** freq) - 1
+
+    vol_tgt = (6 + np.arange(10)) / 100
+    if engine == 'parametric':
+        if workers == 1:
+            membership = [cluster_cache.membership(labels[a]) for a in range(len(labels))]
+            wgt_array = monero_engine_ff.solve_frontier_windows(
+                mu_array, cov_array, membership, vol_tgt, lower_bnd, np.array(upper_bnd), solver = solver, log = solve_log,
+                window_offset = start)
+        else:
+            membership = monero_engine_ff.cluster_membership(labels)
+            wgt_array = monero_engine_ff.parallel_frontier_windows(
+                mu_array, cov_array, membership, vol_tgt, lower_bnd, np.array(upper_bnd), solver = solver,
+                workers = workers, chunk_size = chunk_size, log = solve_log, window_offset = start)
+        return wgt_array, labels
+    elif engine == 'admm':
+        membership = monero_engine_ff.cluster_membership(labels)
+        wgt_array, _ = monero_engine_ff.admm_frontier_windows(
+            mu_array, cov_array, membership, vol_tgt, lower_bnd, np.array(upper_bnd), solver = solver, log = solve_log,
+            window_offset = start)
+        return wgt_array, labels
+    elif engine == 'frontier':
+        membership = monero_engine_ff.cluster_membership(labels)
+        wgt_array = monero_engine_ff.trace_frontier_windows(
+            mu_array, cov_array, membership, vol_tgt, lower_bnd, np.array(upper_bnd), log = solve_log, window_offset = start)
+        return wgt_array, labels
+    elif engine != 'efficient_frontier':
+        raise ValueError('unknown optimizer engine {!r}'.format(engine))
 
 
     ff_wgt_dict = {} #ff for "Fama-French"
@@ -620,110 +701,287 @@ def make_port_asset_wgt_dict(account, window):
 
     rf = 0 #because it is already substracted to asset_rf
 
-    for a in range(b - window):
+    for a in range(len(labels)):
         wgt_temp = []
         riskreturn_temp = []
 
+        mu = pd.Series(mu_array[a], index = expected_return.columns)
+        s = pd.DataFrame(cov_array[a], index = asset_rf.columns, columns = asset_rf.columns)
+        membership = cluster_cache.membership(labels[a])
 
         for i in range(10):
             # vol_tgt = round((6 + i * 1.2) / 100,3) # changed
             vol_tgt = (6 + i) / 100
-            freq = 12 #monthly
-            mu = ((1 + expected_return_rf_dict[a].mean()) ** freq) - 1
-            s = risk_models.risk_matrix(asset_rf_dict[a], method="ledoit_wolf_single_factor", returns_data=True, frequency=freq)
         
-            ef = EfficientFrontier(mu, s) #, solver="ECOS")
-            ef.add_sector_constraints(asset_mapper_dict[a], lower_bnd, upper_bnd[i])
-        
-            raw_wgt = ef.efficient_risk(vol_tgt)
+            ef = make_efficient_risk(mu, s, membership, lower_bnd, upper_bnd[i], vol_tgt, solver, solve_log, start + a)
             wgt_temp.append(ef.clean_weights())
             riskreturn_temp.append(ef.portfolio_performance(risk_free_rate = rf))
     
         ff_wgt_dict[a] = wgt_temp
         ff_riskreturn_dict[a] = riskreturn_temp
 
-    for a in range(b - window):
-        ff_wgt_dict[a] = pd.DataFrame(ff_wgt_dict[a])
-        ff_wgt_dict[a].index = vol_list
+    wgt_array = np.array([pd.DataFrame(ff_wgt_dict[a], columns = expected_return.columns).values for a in range(len(labels))])
     
-    return ff_wgt_dict
+    return wgt_array, labels
+
+
+# What the stored windows were computed from: the settings (with the engine
+# and solvers) and a hash of the excess returns and factors up to the last
+# stored window, with dates.
+def make_window_meta(account, window, engine, n_windows, ctx = None, solver = None):
+    if ctx is None:
+        ctx = DataContext()
+
+    asset_rf, factor_list = ctx.excess_returns(account)
+    rows = n_windows + window - 1
+    digest = hashlib.sha1()
+    digest.update(asset_rf.index[:rows].values.astype('datetime64[ns]').tobytes())
+    digest.update(np.ascontiguousarray(asset_rf.values[:rows]).tobytes())
+    for factors in factor_list:
+        digest.update(np.ascontiguousarray(factors[monero_engine_ff.FACTOR_NAMES].values[:rows]).tobytes())
+
+    return {
+        'window': window,
+        'freq': ctx.freq,
+        'engine': engine,
+        'solver': monero_engine_ff.solver_priority(solver),
+        'columns': list(asset_rf.columns),
+        'n_windows': n_windows,
+        'fingerprint': digest.hexdigest()
+        }
+
+
+# Number of windows of the store still valid for this run and their arrays.
+# They are only used when the settings match and the data they were
+# computed from is unchanged (no revised factor history, ...) and every
+# array holds the n_windows of the meta, anything else starts over from the
+# first window.
+def load_window_results(account, window, engine, window_store, ctx = None, solver = None):
+    meta, arrays = window_store.load(account)
+    if meta is None:
+        return 0, {}
+
+    n_windows = len(make_excess_return_df(account, ctx).index) - window
+    n_stored = meta['n_windows']
+    if n_stored > n_windows or n_stored == 0:
+        return 0, {}
+    current = make_window_meta(account, window, engine, n_stored, ctx, solver)
+    if any(meta.get(k) != v for k, v in current.items()):
+        return 0, {}
+    if any(name not in arrays or len(arrays[name]) < n_stored for name in ['weights', 'labels']):
+        return 0, {}
+    return n_stored, {name: arr[:n_stored] for name, arr in arrays.items()}
+
+
+# Weights of the 10 portfolios of the last window only, the frame of
+# 'make_port_asset_wgt_dict' the asset_weights export uses, without going
+# through the history: one regression, covariance and clustering and the
+# 10 solves.
+# window_store: returns the stored weights when the last window is stored
+#               already, and carries the cluster numbers on from the window
+#               before it (the weights do not depend on them as long as
+#               every cluster has the same bounds)
+def make_current_port_asset_wgt_df(account, window, ctx = None, engine = 'parametric', solver = None, solve_log = None,
+                                   window_store = None):
+    if ctx is None:
+        ctx = DataContext()
+
+    vol_list = ['{:.1f}%'.format(6+i) for i in range(10)]
+
+    asset_rf = make_excess_return_df(account, ctx)
+    n_windows = len(asset_rf.index) - window
+    if n_windows <= 0:
+        raise ValueError('{} periods of {} returns are not enough for a window of {}'.format(len(asset_rf.index), account, window))
+
+    prev_labels = None
+    if window_store is not None:
+        n_stored, stored = load_window_results(account, window, engine, window_store, ctx, solver)
+        if n_stored == n_windows:
+            return pd.DataFrame(stored['weights'][-1], index = vol_list, columns = asset_rf.columns)
+        if n_stored == n_windows - 1:
+            prev_labels = stored['labels'][-1]
+
+    wgt_array, _ = make_port_asset_wgt_array(account, window, ctx, engine = engine, solver = solver, solve_log = solve_log,
+                                             start = n_windows - 1, prev_labels = prev_labels)
+
+    return pd.DataFrame(wgt_array[0], index = vol_list, columns = asset_rf.columns)
+
+
+# EfficientFrontier solved by efficient_risk with the solvers of
+# monero_engine_ff.solver_priority(solver) tried in turn
+def make_efficient_risk(mu, s, membership, lower_bnd, upper_bnd, vol_tgt, solver = None, solve_log = None, window = None):
+    failures = []
+    for name in monero_engine_ff.solver_priority(solver):
+        ef = EfficientFrontier(mu, s, solver = name)
+        ef.add_constraint(lambda w: membership @ w <= upper_bnd)
+        ef.add_constraint(lambda w: membership @ w >= lower_bnd)
+
+        start = time.perf_counter()
+        try:
+            ef.efficient_risk(vol_tgt)
+            status = ef._opt.status
+        except (pypfopt.exceptions.OptimizationError, cvxpy.error.SolverError):
+            status = ef._opt.status if ef._opt is not None and ef._opt.status is not None else 'solver_error'
+        stats = ef._opt.solver_stats if ef._opt is not None and status != 'solver_error' else None
+        if solve_log is not None:
+            solve_log.record(window = window, target = vol_tgt, n_targets = 1, solver = name, status = status,
+                             iterations = getattr(stats, 'num_iters', None), solve_time = getattr(stats, 'solve_time', None),
+                             wall_time = time.perf_counter() - start)
+        if status in {'optimal', 'optimal_inaccurate'}:
+            return ef
+        failures.append('{}: {}'.format(name, status))
+    raise pypfopt.exceptions.OptimizationError('No solver succeeded ({})'.format(', '.join(failures)))
 
 ###8
 # data_dict: result of 'make_port_asset_wgt_dict(account=, window = )'
+# float32: keeps the weights in single precision
 
-def make_backtest_wgt_dict(account, window, data_dict):
-    
-    us_asset_rf, dm_asset_rf, em_asset_rf = make_asset_rf(account)
-    asset_rf = pd.concat([us_asset_rf, dm_asset_rf, em_asset_rf], axis = 1)
+# monero_engine_ff.WeightsCube of the windows' weights, held from the period
+# after each window's date
+def make_backtest_wgt_cube(account, window, data_dict, ctx = None, float32 = False):
+    if ctx is None:
+        ctx = DataContext()
+
+    asset_rf = make_excess_return_df(account, ctx)
     b = len(asset_rf.index)
 
-    port_list = list(data_dict[0].index) 
+    port_list = data_dict[0].index
+    col_list = data_dict[0].columns
+
+    values = np.empty((b - window, len(port_list), len(col_list)), dtype = np.float32 if float32 else np.float64)
+    for j in range(b - window):
+        values[j] = data_dict[j].loc[port_list, col_list].values
+
+    cube = monero_engine_ff.WeightsCube(values, asset_rf[window:][:(b-window)].index, port_list, col_list, ctx.freq, float32)
+
+    # the time lag of factor data release is assumed to be one period
+    return cube.lag(1)
 
-    ff_backtest_wgt = {}
-    
-    for i, k in enumerate(port_list):
-        temp_df = pd.DataFrame()   
-        
-        for j in range(b - window):
-            temp = pd.DataFrame.from_dict(data_dict[j].loc[k]) #, orient = 'index', columns = [j])
-            temp = temp.T
-            temp_df = pd.concat([temp_df, temp], axis = 0)
-            
-        temp_df.index = asset_rf[window:][:(b-window)].index
-    
-        #saving last row(it will be dropped after shift(1))
-        temp_last_row = pd.DataFrame(temp_df[-1:])
-        last_month_end = temp_last_row.index[0] + pd.offsets.MonthEnd(1)
-        temp_last_row.rename(index = {temp_last_row.index[0] : last_month_end}, inplace = True)
-    
-        # the time lag of factor data release is assumed to be 1M
-        temp_df = temp_df.shift(1) 
-        temp_df = temp_df[1:]
-        temp_df = pd.concat([temp_df, temp_last_row])
-        ff_backtest_wgt[k] = temp_df    
-    
-    return ff_backtest_wgt
+
+# the cube as one dates x assets frame per portfolio
+def make_backtest_wgt_dict(account, window, data_dict, ctx = None, float32 = False):
+    return make_backtest_wgt_cube(account, window, data_dict, ctx, float32).to_dict()
 
 ###9
 # data_dict: result of 'make_backtest_wgt_dict(account=, window=, data_dict=)'
+#            or 'make_backtest_wgt_cube'
+# rebalance: 'W', 'M' or 'Q', the weights drift with the returns between the
+#            first dates of those periods; None trades back to the target
+#            weights on every date
+# threshold: also rebalances a portfolio once one of its weights drifted
+#            more than this from target (see monero_engine_ff.portfolio_returns)
+# Dates without returns yet (the period after the last window) are left out.
+
+def make_portfolio_rt_df(account, data_dict, ctx = None, rebalance = None, threshold = None):
+    return make_portfolio_rt(account, data_dict, ctx, rebalance, threshold)[0]
+
+
+# the returns of 'make_portfolio_rt_df' and the frame of the dates each
+# portfolio was rebalanced
+def make_portfolio_rt(account, data_dict, ctx = None, rebalance = None, threshold = None):
+    if ctx is None:
+        ctx = DataContext()
+    asset_m = load_asset_data(account, ctx)
+    cube = make_wgt_cube(data_dict, ctx.freq)
 
-def make_portfolio_rt_df(account, data_dict):
-    asset_m =load_asset_data(account)
-    
     # time lag of the data release(1M) is considered
-    date_list = list(data_dict['6.0%'].index)
-    asset_m_test = asset_m[asset_m.index.isin(date_list)]
-    
-    ff_portfolio_rt = pd.DataFrame()
-    port_list = list(data_dict.keys())
-
-    for i,j in enumerate(port_list):
-        temp_rt = asset_m_test * data_dict[j]
-        temp_rt = temp_rt.sum(axis = 1)
-        ff_portfolio_rt[j] = temp_rt
-        
-    ew_rt = asset_m_test * (1/asset_m_test.shape[1])
-    ew_rt = ew_rt.sum(axis = 1)
-    ff_portfolio_rt['EW'] = ew_rt
-    
-    traditional_rt = asset_m_test["US Stocks - Size (Large Cap)"] * (0.6) + asset_m_test["US Government Bonds - Long Term"] * (0.4)
-    ff_portfolio_rt['60/40'] = traditional_rt
-    
-    ff_portfolio_rt
+    in_asset_m = cube.dates.isin(asset_m.index)
+    date_list = cube.dates[in_asset_m]
+    asset_m_test = asset_m.loc[date_list]
+    if rebalance is not None:
+        rebalance = monero_engine_ff.rebalance_mask(date_list, rebalance)
+
+    port_list = list(cube.ports)
+    weights = cube.values if in_asset_m.all() else cube.values[in_asset_m]
+    port_rt, rebalanced = monero_engine_ff.portfolio_returns(
+        weights, asset_m_test[cube.assets].values, rebalance, threshold)
+
+    # benchmarks, rebalanced the same way
+    bench_list, bench_wgt = make_benchmark_wgt(asset_m_test.columns)
+    bench_wgt = np.broadcast_to(bench_wgt, (len(date_list),) + bench_wgt.shape)
+    bench_rt, bench_rebalanced = monero_engine_ff.portfolio_returns(bench_wgt, asset_m_test.values, rebalance, threshold)
+
+    ff_portfolio_rt = pd.DataFrame(np.hstack([port_rt, bench_rt]), index = date_list, columns = port_list + bench_list)
+    ff_rebalanced = pd.DataFrame(np.hstack([rebalanced, bench_rebalanced]), index = date_list, columns = port_list + bench_list)
+
+    return ff_portfolio_rt, ff_rebalanced
+
+
+# data_dict as a monero_engine_ff.WeightsCube
+def make_wgt_cube(data_dict, freq = 'M'):
+    if isinstance(data_dict, monero_engine_ff.WeightsCube):
+        return data_dict
+    frame_list = list(data_dict.values())
+    values = np.stack([df.values for df in frame_list], axis = 1)
+    return monero_engine_ff.WeightsCube(values, frame_list[0].index, list(data_dict.keys()), frame_list[0].columns, freq)
+
+
+# EW and 60/40 (when both assets are there) weights of the assets
+def make_benchmark_wgt(col_list):
+    col_list = pd.Index(col_list)
+    bench_list = ['EW']
+    bench_wgt = [np.full(len(col_list), 1 / len(col_list))]
+    if "US Stocks - Size (Large Cap)" in col_list and "US Government Bonds - Long Term" in col_list:
+        bench_list.append('60/40')
+        bench_wgt.append(0.6 * (col_list == "US Stocks - Size (Large Cap)") + 0.4 * (col_list == "US Government Bonds - Long Term"))
+    return bench_list, np.array(bench_wgt)
+
+
+# Daily returns of the portfolios and benchmarks. Every period's weights are
+# bought on its first day and drift with the daily returns until the next
+# one, and the daily etf returns are read about a year at a time (see
+# monero_engine_ff.stream_daily_returns). EW is equally weighted over the
+# portfolios' assets.
+def make_daily_portfolio_rt_df(account, data_dict, ctx = None):
+    if ctx is None:
+        ctx = DataContext()
+
+    cube = make_wgt_cube(data_dict, ctx.freq)
+    col_list = list(cube.assets)
+    bench_list, bench_wgt = make_benchmark_wgt(col_list)
+    bench_wgt = np.broadcast_to(bench_wgt, (len(cube.dates),) + bench_wgt.shape)
+    cube = monero_engine_ff.WeightsCube(np.concatenate([cube.values, bench_wgt.astype(cube.values.dtype)], axis = 1),
+                                        cube.dates, list(cube.ports) + bench_list, col_list, ctx.freq,
+                                        cube.values.dtype == np.float32)
+
+    # days missing any of the assets are left out, as in 'make_asset_m'
+    chunks = (tr.dropna() for tr in ctx.daily_chunks(col_list))
+    return pd.concat(list(monero_engine_ff.stream_daily_returns(cube, chunks)), axis = 0)
+
+
+# Annualised return and volatility, and rebalances per year, of the
+# portfolios under each rebalance policy.
+#   policies: {name: (rebalance, threshold)} as in 'make_portfolio_rt_df'
+def make_rebalance_study_df(account, data_dict, policies, ctx = None):
+    if ctx is None:
+        ctx = DataContext()
+    freq = ctx.periods_per_year()
+
+    study = {}
+    for name, (rebalance, threshold) in policies.items():
+        port_rt, rebalanced = make_portfolio_rt(account, data_dict, ctx, rebalance, threshold)
+        study[name] = pd.DataFrame({
+            'Historical Return': ((1 + port_rt.mean()) ** freq - 1) * 100,
+            'Historical Volatility': port_rt.std() * ((freq)**(1/2)) * 100,
+            'Rebalances per Year': rebalanced.mean() * freq
+            })
 
-    return ff_portfolio_rt
+    return pd.concat(study, names = ['Policy', 'Portfolio'])
 
 ###10
 # data_df: result of 'make_portfolio_rt_df(account = , data_dict = )'
+# daily_df: result of 'make_daily_portfolio_rt_df(account = , data_dict = )',
+#           adds the volatility and 3 year MDD of the daily returns
+
+TRADING_DAYS = 252
+
 
-def make_port_analysis_df(data_df):
+def make_port_analysis_df(data_df, ctx = None, daily_df = None):
+    if ctx is None:
+        ctx = DataContext()
 
     # Load Mkt-RF, RF data
-    start = dt.date(1990,7,1)
-    factors = reader.DataReader('F-F_Research_Data_5_Factors_2x3','famafrench',start)[0]
-    month_end_list = pd.date_range(start = start, end = None, periods = factors.shape[0], freq = 'M')
-    factors.index = list(month_end_list)
-    factors = factors / 100
+    factors = ctx.factors()[0]
 
     intersection_date = list(set(list(factors.index))&set(list(data_df.index)))
     intersection_date.sort()
@@ -741,7 +999,7 @@ def make_port_analysis_df(data_df):
     historical_return = {}
     historical_vol = {}
     
-    freq = 12 # monthly data
+    freq = ctx.periods_per_year()
     rf = ((1 + rf_series.mean()) ** freq - 1) * 100
     rm_rf = ((1 + mkt_series.mean()) ** freq - 1) * 100
     
@@ -767,13 +1025,27 @@ def make_port_analysis_df(data_df):
     # MDD for past 3 years
     port_price = data_df.copy()
     port_price = (1+port_price).cumprod()
-    roll_max = port_price.rolling(36, min_periods=1).max()
+    roll_max = port_price.rolling(3 * freq, min_periods=1).max()
     monthly_drawdown = port_price/roll_max - 1.0
-    max_drawdown = monthly_drawdown.rolling(36, min_periods=1).min()
+    max_drawdown = monthly_drawdown.rolling(3 * freq, min_periods=1).min()
     mdd = max_drawdown[-1:].T * 100
     mdd.columns = ['MDD']
 
     port_stats = pd.concat([port_stats,mdd], axis = 1)
+
+    # daily returns of the same periods
+    if daily_df is not None:
+        period_freq = monero_engine_ff.PERIOD_DICT[ctx.freq][0]
+        period_list = pd.DatetimeIndex(intersection_date).to_period(period_freq)
+        daily_df = daily_df[daily_df.index.to_period(period_freq).isin(period_list)]
+
+        port_stats['Daily Volatility'] = daily_df.std() * ((TRADING_DAYS)**(1/2)) * 100
+
+        daily_price = (1+daily_df).cumprod()
+        roll_max = daily_price.rolling(3 * TRADING_DAYS, min_periods=1).max()
+        daily_drawdown = daily_price/roll_max - 1.0
+        max_drawdown = daily_drawdown.rolling(3 * TRADING_DAYS, min_periods=1).min()
+        port_stats['Daily MDD'] = max_drawdown.iloc[-1] * 100
     
     return port_stats
 